@@ -1,14 +1,13 @@
 from collections import defaultdict
-import csv
+import json
 import logging
+from multiprocessing import cpu_count
 import os
-import re
 import sys
 
 from flask import current_app, g
 from flask.ext.script import Manager
 import nose
-import requests
 
 from orvsd_central import create_app
 from orvsd_central.database import (create_db_session, create_admin_account,
@@ -48,79 +47,104 @@ def gather_tokens():
     """
     For all sites added to ORVSD_Central's database and all services listed
     in the MOODLE_SERVICES config option, gather will gather all tokens for
-    each service of every site
+    each service of every site, TOKEN_HARVEST_WORKERS at a time
     """
 
     with current_app.app_context():
         from orvsd_central.models import Site
-        from orvsd_central.util import gather_tokens
+        from orvsd_central.util import harvest_tokens
         g.db_session = create_db_session()
 
-        for site in Site.query.all():
-            gather_tokens(site)
+        harvest_tokens(Site.query.all())
+
+
+@manager.command
+def resume_installs():
+    """
+    Queue every course install that previously failed again, one install
+    task per site
+    """
+
+    with current_app.app_context():
+        from orvsd_central.models import FailedInstall, Site
+        from orvsd_central.util import interleave_by_host, queue_installs
+        g.db_session = create_db_session()
+
+        failed = defaultdict(list)
+        for failure in FailedInstall.query.all():
+            failed[failure.site_id].append(failure.course_id)
+
+        sites = Site.query.filter(Site.id.in_(failed.keys())).all() \
+            if failed else []
+        sites = interleave_by_host(sites)
+
+        batch = queue_installs([(site, failed[site.id]) for site in sites])
+
+        for site in sites:
+            print "Queued %d course install(s) for %s" % (
+                len(failed[site.id]), site.name
+            )
+        print "Follow the rollout at /1/installs/%s/events" % batch
+
+
+@manager.option('-d', '--days', type=int,
+                help="Keep results of tasks finished in this many days")
+def compact_task_results(days):
+    """
+    Replace old celery task results with short summaries
+    """
+
+    with current_app.app_context():
+        from orvsd_central.util import compact_task_results
+        g.db_session = create_db_session()
+
+        print "Compacted %d task results" % compact_task_results(days)
+
+
+@manager.command
+def index_courses():
+    """
+    Rebuild the course search index from every course in the catalog
+    """
+
+    with current_app.app_context():
+        from orvsd_central.models import Course
+        from orvsd_central.util import index_courses
+        g.db_session = create_db_session()
+
+        courses = Course.query.all()
+        index_courses(courses)
+        g.db_session.commit()
+
+        print "Indexed %d courses" % len(courses)
 
 
 @manager.option('-d', "--data", help="CSV to import of Districts and Schools")
-def import_data(data):
+@manager.option('-s', '--chunk-size', dest='chunk_size', type=int,
+                help="Rows to commit at a time")
+@manager.option('-r', '--resume', action='store_true', default=False,
+                help="Carry on after the last committed chunk")
+def import_data(data, chunk_size, resume):
     """
     CSV Format
     District State ID, District, School State ID, School, County
     """
 
-    # schools are a list of values for the discricts (keys)
-    district_schools = defaultdict(list)
-    dist_state_ids = dict()
-
-    with open(data, 'r') as csvfile:
-        schools = csv.reader(csvfile)
-        for row in schools:
-            dist_state_ids[row[1]] = row[0]
-            district_schools[row[1]].append(row[2:])
-
     with current_app.app_context():
         # Create a db session
         g.db_session = create_db_session()
-        from orvsd_central.models import District, School
-
-        # Only words, no symbols
-        pattern = re.compile('[\W_]+')
-
-        # For all the districts
-        for key in district_schools.keys():
-            # Search for the district or create it if it doesn't exist
-            district = g.db_session.query(District).filter(
-                District.name == key
-            ).first()
-
-            if not district:
-                district = District(
-                    state_id=dist_state_ids[key],
-                    name=key,
-                    shortname=pattern.sub('', key)
-                )
-                g.db_session.add(district)
-                g.db_session.commit()
-
-            # For the schools in the district, see if it exists,
-            # else create it
-            for school_row in district_schools[key]:
-                school = g.db_session.query(School).filter(
-                    School.name == school_row[1]
-                ).first()
-
-                if not school:
-                    s = School(
-                        district_id=district.id,
-                        state_id=school_row[0],
-                        name=school_row[1],
-                        shortname=pattern.sub('', school_row[1]),
-                        county=school_row[2]
-                    )
-                    g.db_session.add(s)
-
-            # Commit the schools to the db
-            g.db_session.commit()
-
+        from orvsd_central.util import stream_import
+
+        # Districts and schools are matched on their state ids
+        counts = stream_import(data, chunk_size, resume)
+
+    if counts['resumed']:
+        print "Resumed after line %d" % counts['resumed']
+    print ("Districts: {districts_created} created, {districts_updated} "
+           "updated".format(**counts))
+    print ("Schools: {schools_created} created, {schools_updated} updated, "
+           "{unchanged} unchanged".format(**counts))
+    print "Rows skipped: %d" % counts['skipped']
     print "Data imported"
 
 
@@ -184,26 +208,35 @@ def update_sites(data):
         # Create a db session
         g.db_session = create_db_session()
         from orvsd_central.models import Site
-        from orvsd_central.util import gather_siteinfo, gather_tokens
+        from orvsd_central.util import (add_sites, onboard_sites,
+                                        probe_sites, remove_sites)
 
         # Used for finding a default nginx page.
         random_domain = 'http://randomdomain.oregonachieves.org'
-        nginx_default = requests.get(random_domain).text
 
         orvsd_sites = set(
             map(lambda x: x[0], g.db_session.query(Site.baseurl).distinct())
         )
         filepaths = {}
-        server_sites = set()
         with open(data, 'r') as f:
             prefix = '/var/www/'
             for line in f.readlines():
                 line = line.strip()  # Get rid of new line char
-                base_url = line.split('/')[-1]
-                # Confirm we only save sites that are running.
-                if requests.get('http://' + base_url).text != nginx_default:
+                if line:
+                    base_url = line.split('/')[-1]
                     filepaths[base_url] = '%s/' % line.replace('./', prefix)
-                    server_sites.add(base_url)
+
+        # Confirm we only save sites that are running.
+        running = probe_sites(filepaths.keys(), random_domain)
+        server_sites = set(base_url for base_url, up in running.items() if up)
+
+        # Sites that didn't answer are left as they are
+        unreachable = set(base_url for base_url, up in running.items()
+                          if up is None)
+        orvsd_sites -= unreachable
+        if unreachable:
+            print 'Unable to reach %d sites:' % len(unreachable)
+            print '\t' + '\n\t'.join(unreachable)
 
         if not server_sites:
             print 'No sites retrieved from input file. Was the format correct?'
@@ -222,45 +255,33 @@ def update_sites(data):
                 'sitetype': 'moodle',
                 'baseurl': site,
                 'basepath': filepaths[site],
-                'location': '',
-                'moodle_tokens': ''
+                'location': ''
             }
 
         print 'Sites cross-referenced. '
         print 'Added %d sites:' % len(to_add)
         print '\t' + '\n\t'.join(to_add)
 
-        # Add sites that weren't in ORVSD
-        new_sites = []
-        for base_url, site_info in to_add.items():
-            new_site = Site(**site_info)
-            new_sites.append(new_site)
-            g.db_session.add(new_site)
-        g.db_session.commit()
-
-        # Delete sites that weren't on the server.
+        # Add sites that weren't in ORVSD, and delete sites that weren't on
+        # the server, all at once
+        new_site_ids = add_sites(to_add.values())
         not_in_server = orvsd_sites - server_sites
-        to_delete = g.db_session.query(Site).filter(
-            Site.baseurl.in_(not_in_server)
-        ).all()
-        base_urls = [site.baseurl for site in to_delete]
-        for site in to_delete:
-            g.db_session.delete(site)
+        remove_sites(list(not_in_server))
         g.db_session.commit()
 
-        print 'Deleted %d sites:' % len(base_urls)
-        print '\t' + '\n\t'.join(base_urls)
+        print 'Deleted %d sites:' % len(not_in_server)
+        print '\t' + '\n\t'.join(not_in_server)
 
-        # Gather tokens and siteinfo
-        print 'Gathering tokens and siteinfo...'
-        map(gather_tokens, new_sites)
-        map(gather_siteinfo, new_sites)
+        # The collection workers gather tokens and siteinfo
+        shards = onboard_sites(new_site_ids)
+        print 'Queued token and siteinfo gathering in %d shards.' % shards
 
         print 'Sites updated.'
 
 
-@manager.command
-def assoc_sites_districts():
+@manager.option('-w', '--workers', type=int, default=1,
+                help="Processes to match sites in, all cores if 0")
+def assoc_sites_districts(workers):
     """
     Associates orphan sites with districts either through fuzzy matching
     or creating schools as intermediaries between sites and districts.
@@ -269,67 +290,221 @@ def assoc_sites_districts():
     with current_app.app_context():
         g.db_session = create_db_session()
         from orvsd_central.models import Site, School, District
-        from orvsd_central.util import create_school_by_district_site
-        from collections import namedtuple
-        import pylev
-
-        orphan_sites = set(Site.query.filter_by(school_id=None).all())
-        assigned_sites = set()
-        schools = School.query.all()
-        num_matches = 0
-        match_tuple = namedtuple('match', ['id', 'name'])
-        match = None
-
-        # If a site belongs to more than 1 school, just default to creating
-        # by a district.
+        from orvsd_central.util import (NameIndex,
+                                        create_school_by_district_site,
+                                        match_orphan_sites)
+
+        orphan_sites = dict((site.id, site) for site in
+                            Site.query.filter_by(school_id=None).all())
+
+        # Names as subsets of each other, or <=3 levenshtein distance apart,
+        # match. If a site matches more than 1 school, just default to
+        # creating by a district.
+        schools = NameIndex((school.id, school.name)
+                            for school in School.query.all())
+        districts = dict((district.id, district)
+                         for district in District.query.all())
+        district_names = NameIndex((district.id, district.name)
+                                   for district in districts.values())
+
+        matches = match_orphan_sites(
+            [(site.id, site.name) for site in orphan_sites.values()],
+            schools, district_names, workers or cpu_count()
+        )
 
         print 'School Matching:'
-        for site in orphan_sites:
-            for school in schools:
-                # Check for names as subsets or <=3 levenshtein distance.
-                if (site.name in school.name or school.name in site.name or
-                        pylev.levenshtein(site.name, school.name) <= 3):
-                    num_matches += 1
-                    match = match_tuple(id=school.id, name=school.name)
-            if num_matches == 1:
-                print ('School: {0} and Site: {1} matched.'
-                       .format(match.name, site.name))
+        for site_id, kind, match in matches:
+            if kind == 'school':
+                site = orphan_sites.pop(site_id)
+                print ('School: {0} and Site: {1} matched ({2:.2f}).'
+                       .format(match.name, site.name, match.score))
                 site.school_id = match.id
-                assigned_sites.add(site)
-            num_matches = 0
-            match = None 
-
-        g.db_session.commit()
-        orphan_sites = orphan_sites - assigned_sites
 
         print '\nDistrict Matching: '
 
-        # Districts next, with anything that's left.
-        districts = District.query.all()
-        for site in orphan_sites:
-            for district in districts:
-                if site.name in district.name or district.name in site.name:
-                    print ('District: {0} or Site: {1} contained in the other.'
-                           .format(district.name, site.name))
-                    school = create_school_by_district_site(district, site)
-                    site.school_id = school.id
-                    assigned_sites.add(site)
-                    break
-
-                # Use Levenshtein Distance for fuzzy matching
-                elif pylev.levenshtein(site.name, school.name) <= 3:
-                    print ('District: {0} and Site: {1} fuzzy matched.'
-                           .format(district.name, site.name))
-                    school = create_school_by_district_site(district, site)
-                    site.school_id = school.id
-                    assigned_sites.add(site)
-                    break
+        # Districts next, with anything that's left
+        for site_id, kind, match in matches:
+            if kind == 'district':
+                site = orphan_sites.pop(site_id)
+                district = districts[match.id]
+                print ('District: {0} and Site: {1} matched ({2:.2f}).'
+                       .format(district.name, site.name, match.score))
+                school = create_school_by_district_site(district, site,
+                                                        commit=False)
+                site.school_id = school.id
 
         g.db_session.commit()
-        orphan_sites = orphan_sites - assigned_sites
 
         print '\nRemaining Sites: '
-        print '\t' + '\n\t'.join((site.name for site in orphan_sites))
+        print '\t' + '\n\t'.join((site.name for site in
+                                   orphan_sites.values()))
+
+
+@manager.option('--districts', type=int, default=20, help="Districts")
+@manager.option('--schools', type=int, default=5,
+                help="Schools per district")
+@manager.option('--sites', type=int, default=2, help="Sites per school")
+@manager.option('--details', type=int, default=10,
+                help="SiteDetails per moodle site")
+@manager.option('--courses', type=int, default=50,
+                help="Courses per siteinfo")
+@manager.option('--seed', type=int, help="Seed to repeat a dataset")
+@manager.option('--clear', action='store_true', default=False,
+                help="Remove the synthetic data instead")
+def generate_data(districts, schools, sites, details, courses, seed, clear):
+    """
+    Fills the database with synthetic districts, schools, sites and siteinfo
+    for benchmarking, see the benchmark command
+    """
+
+    with current_app.app_context():
+        g.db_session = create_db_session()
+        from orvsd_central.benchmark import clear_dataset, generate_dataset
+
+        if clear:
+            print "Removed %d synthetic sites" % clear_dataset()
+            return
+
+        # A fresh SQLite database has no tables yet
+        if current_app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'):
+            init_db()
+
+        counts = generate_dataset(districts, schools, sites, details,
+                                  courses, seed=seed)
+
+    print ("Created {districts} districts, {schools} schools, {sites} sites "
+           "and {site_details} site details".format(**counts))
+
+
+@manager.option('-r', '--repeat', type=int, default=5,
+                help="Runs of each benchmark")
+@manager.option('-o', '--output', help="File to save the results to, as json")
+@manager.option('-b', '--baseline',
+                help="Results saved earlier to compare against")
+def benchmark(repeat, output, baseline):
+    """
+    Times the report queries and API calls, and counts their queries
+    """
+
+    with current_app.app_context():
+        g.db_session = create_db_session()
+        from orvsd_central.benchmark import run_benchmarks
+
+        results = run_benchmarks(repeat)
+
+    if not results:
+        print "No schools to benchmark, see generate_data"
+        return
+
+    previous = {}
+    if baseline:
+        with open(baseline, 'r') as f:
+            previous = dict((result['name'], result)
+                            for result in json.load(f))
+
+    print "%-32s %10s %10s %10s %8s" % ('', 'min', 'median', 'max',
+                                         'queries')
+    for result in results:
+        line = "%-32s %9.1fms %9.1fms %9.1fms %8d" % (
+            result['name'], result['min'] * 1000, result['median'] * 1000,
+            result['max'] * 1000, result['queries']
+        )
+
+        before = previous.get(result['name'])
+        if before:
+            line += "  (median x%.2f, %+d queries)" % (
+                result['median'] / max(before['median'], 1e-6),
+                result['queries'] - before['queries']
+            )
+        print line
+
+    if output:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+def fake_moodle_options(command):
+    """
+    Adds the options of a FakeMoodle to 'command'.
+    """
+    options = [
+        ('--latency', float, 0.0, "Seconds every request takes"),
+        ('--jitter', float, 0.0, "Up to this many seconds more, at random"),
+        ('--error-rate', float, 0.0, "Share of requests answered with a 503"),
+        ('--hang-rate', float, 0.0, "Share of requests that hang"),
+        ('--hang', float, 3600, "Seconds a hanging request takes"),
+        ('--courses', int, 50, "Courses in each siteinfo"),
+        ('--install-time', float, 0.0, "Seconds a course install takes"),
+        ('--seed', int, None, "Seed to repeat a run")
+    ]
+    for name, type_, default, help in options:
+        manager.option(name, dest=name[2:].replace('-', '_'), type=type_,
+                       default=default, help=help)(command)
+    return command
+
+
+@manager.option('--host', default='127.0.0.1', help="Address to listen on")
+@manager.option('--port', type=int, default=8765, help="Port to listen on")
+@fake_moodle_options
+def fake_moodle(host, port, **options):
+    """
+    Serves a fake moodle, answering token, siteinfo and install requests for
+    any number of sites
+    """
+    import time
+    from orvsd_central.fakemoodle import FakeMoodle, start_server
+
+    app = FakeMoodle(**options)
+    server = start_server(app, host, port, log_requests=True)
+    print "Fake moodle sites at http://%s:%d/<site>/" % (host,
+                                                         server.server_port)
+
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+    print ', '.join('%s: %d' % item for item in sorted(app.stats.items()))
+
+
+@manager.option('--sites', type=int, default=50, help="Sites to create")
+@manager.option('--install-courses', dest='install_courses', type=int,
+                default=5, help="Courses to install to each site")
+@manager.option('--workers', type=int, default=4,
+                help="Tasks to run at once")
+@manager.option('--hosts', type=int,
+                help="Hosts to spread the sites over, one per site by default")
+@manager.option('--timeout', type=float,
+                help="Seconds to wait for an answer, overriding the config")
+@fake_moodle_options
+def load_test(sites, install_courses, workers, hosts, timeout, **options):
+    """
+    Runs the collection and install tasks for temporary sites on a fake
+    moodle, timing each step
+    """
+
+    with current_app.app_context():
+        g.db_session = create_db_session()
+        from orvsd_central.benchmark import run_load_test
+        from orvsd_central.fakemoodle import FakeMoodle, start_server
+
+        app = FakeMoodle(**options)
+        server = start_server(app)
+        try:
+            results = run_load_test('127.0.0.1:%d' % server.server_port,
+                                    sites, install_courses, workers, hosts,
+                                    timeout)
+        finally:
+            server.shutdown()
+
+    print "%-16s %10s %8s %8s %8s" % ('', 'seconds', 'ok', 'failed',
+                                      'errors')
+    for result in results:
+        print "%-16s %10.2f %8d %8d %8d" % (result['name'], result['seconds'],
+                                            result['ok'], result['failed'],
+                                            result['errors'])
+    print ', '.join('%s: %d' % item for item in sorted(app.stats.items()))
 
 
 @manager.option('-n', '--nosetest', help="Specific tests for nose to run")
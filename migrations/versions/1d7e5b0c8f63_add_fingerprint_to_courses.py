@@ -0,0 +1,33 @@
+"""add fingerprint to courses
+
+Revision ID: 1d7e5b0c8f63
+Revises: 3c1f9a7d2e44
+Create Date: 2026-10-19 10:03:17.220945
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '1d7e5b0c8f63'
+down_revision = '3c1f9a7d2e44'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade(engine_name):
+    eval("upgrade_%s" % engine_name)()
+
+
+def downgrade(engine_name):
+    eval("downgrade_%s" % engine_name)()
+
+
+def upgrade_engine1():
+    # Existing courses are fingerprinted by the next course list update
+    op.add_column('courses', sa.Column('fingerprint', sa.String(64)))
+    op.create_index('ix_courses_fingerprint', 'courses', ['fingerprint'])
+
+
+def downgrade_engine1():
+    op.drop_index('ix_courses_fingerprint', 'courses')
+    op.drop_column('courses', 'fingerprint')
@@ -0,0 +1,48 @@
+"""add failed installs
+
+Revision ID: 2a94e0f7c3d1
+Revises: 5f2a8c61d9b7
+Create Date: 2026-10-19 11:27:05.613482
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '2a94e0f7c3d1'
+down_revision = '5f2a8c61d9b7'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade(engine_name):
+    eval("upgrade_%s" % engine_name)()
+
+
+def downgrade(engine_name):
+    eval("downgrade_%s" % engine_name)()
+
+
+def upgrade_engine1():
+    op.create_table(
+        'failed_installs',
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column(
+            'site_id',
+            sa.Integer,
+            sa.ForeignKey('sites.id', name='fk_failed_installs_site_id')
+        ),
+        sa.Column(
+            'course_id',
+            sa.Integer,
+            sa.ForeignKey('courses.id', name='fk_failed_installs_course_id')
+        ),
+        sa.Column('error', sa.Text),
+        sa.Column('attempts', sa.Integer, default=0),
+        sa.Column('failed', sa.DateTime)
+    )
+    op.create_index('ix_failed_installs_site_id',
+                    'failed_installs', ['site_id'])
+
+
+def downgrade_engine1():
+    op.drop_table('failed_installs')
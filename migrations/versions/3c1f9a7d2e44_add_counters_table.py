@@ -0,0 +1,50 @@
+"""add counters table
+
+Revision ID: 3c1f9a7d2e44
+Revises: 506c416e8750
+Create Date: 2026-10-19 09:12:41.503118
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3c1f9a7d2e44'
+down_revision = '506c416e8750'
+
+from alembic import op
+import sqlalchemy as sa
+
+from orvsd_central.constants import COURSE_SERIAL_COUNTER, COURSE_SERIAL_START
+
+
+def upgrade(engine_name):
+    eval("upgrade_%s" % engine_name)()
+
+
+def downgrade(engine_name):
+    eval("downgrade_%s" % engine_name)()
+
+
+def upgrade_engine1():
+    op.create_table(
+        'counters',
+        sa.Column('name', sa.String(64), primary_key=True),
+        sa.Column('value', sa.Integer, nullable=False, default=0)
+    )
+    counters = sa.sql.table(
+        'counters',
+        sa.sql.column('name', sa.String),
+        sa.sql.column('value', sa.Integer)
+    )
+
+    # Continue handing out course serials after the largest one in use
+    connection = op.get_bind()
+    highest = connection.execute("SELECT MAX(serial) FROM courses;").scalar()
+
+    op.bulk_insert(counters, [{
+        'name': COURSE_SERIAL_COUNTER,
+        'value': max(highest or 0, COURSE_SERIAL_START - 1)
+    }])
+
+
+def downgrade_engine1():
+    op.drop_table('counters')
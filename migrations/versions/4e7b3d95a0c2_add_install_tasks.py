@@ -0,0 +1,42 @@
+"""add install tasks
+
+Revision ID: 4e7b3d95a0c2
+Revises: 2a94e0f7c3d1
+Create Date: 2026-10-19 12:15:38.094716
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '4e7b3d95a0c2'
+down_revision = '2a94e0f7c3d1'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade(engine_name):
+    eval("upgrade_%s" % engine_name)()
+
+
+def downgrade(engine_name):
+    eval("downgrade_%s" % engine_name)()
+
+
+def upgrade_engine1():
+    op.create_table(
+        'install_tasks',
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('batch', sa.String(36)),
+        sa.Column('task_id', sa.String(255)),
+        sa.Column(
+            'site_id',
+            sa.Integer,
+            sa.ForeignKey('sites.id', name='fk_install_tasks_site_id')
+        ),
+        sa.Column('queued', sa.DateTime)
+    )
+    op.create_index('ix_install_tasks_batch', 'install_tasks', ['batch'])
+
+
+def downgrade_engine1():
+    op.drop_table('install_tasks')
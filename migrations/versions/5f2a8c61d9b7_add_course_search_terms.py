@@ -0,0 +1,47 @@
+"""add course search terms
+
+Revision ID: 5f2a8c61d9b7
+Revises: 1d7e5b0c8f63
+Create Date: 2026-10-19 10:41:52.870331
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5f2a8c61d9b7'
+down_revision = '1d7e5b0c8f63'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade(engine_name):
+    eval("upgrade_%s" % engine_name)()
+
+
+def downgrade(engine_name):
+    eval("downgrade_%s" % engine_name)()
+
+
+def upgrade_engine1():
+    # Populate the table afterwards with `manage.py index_courses`
+    op.create_table(
+        'course_search_terms',
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column(
+            'course_id',
+            sa.Integer,
+            sa.ForeignKey(
+                'courses.id',
+                name='fk_course_search_terms_course_id'
+            )
+        ),
+        sa.Column('term', sa.String(64))
+    )
+    op.create_index('ix_course_search_terms_course_id',
+                    'course_search_terms', ['course_id'])
+    op.create_index('ix_course_search_terms_term',
+                    'course_search_terms', ['term'])
+
+
+def downgrade_engine1():
+    op.drop_table('course_search_terms')
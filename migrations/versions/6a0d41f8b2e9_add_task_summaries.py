@@ -0,0 +1,37 @@
+"""add task summaries
+
+Revision ID: 6a0d41f8b2e9
+Revises: 4e7b3d95a0c2
+Create Date: 2026-10-19 13:02:44.751890
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '6a0d41f8b2e9'
+down_revision = '4e7b3d95a0c2'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade(engine_name):
+    eval("upgrade_%s" % engine_name)()
+
+
+def downgrade(engine_name):
+    eval("downgrade_%s" % engine_name)()
+
+
+def upgrade_engine1():
+    op.create_table(
+        'task_summaries',
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('task_id', sa.String(255), unique=True),
+        sa.Column('status', sa.String(50)),
+        sa.Column('outcome', sa.String(255)),
+        sa.Column('date_done', sa.DateTime)
+    )
+
+
+def downgrade_engine1():
+    op.drop_table('task_summaries')
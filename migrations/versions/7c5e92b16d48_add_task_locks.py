@@ -0,0 +1,36 @@
+"""add task locks
+
+Revision ID: 7c5e92b16d48
+Revises: 6a0d41f8b2e9
+Create Date: 2026-10-19 13:48:09.316254
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '7c5e92b16d48'
+down_revision = '6a0d41f8b2e9'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade(engine_name):
+    eval("upgrade_%s" % engine_name)()
+
+
+def downgrade(engine_name):
+    eval("downgrade_%s" % engine_name)()
+
+
+def upgrade_engine1():
+    op.create_table(
+        'task_locks',
+        sa.Column('name', sa.String(64), primary_key=True),
+        sa.Column('holder', sa.String(36)),
+        sa.Column('expires', sa.DateTime),
+        sa.Column('pending', sa.Integer, default=0)
+    )
+
+
+def downgrade_engine1():
+    op.drop_table('task_locks')
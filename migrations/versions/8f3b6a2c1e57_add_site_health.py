@@ -0,0 +1,43 @@
+"""add site health
+
+Revision ID: 8f3b6a2c1e57
+Revises: 7c5e92b16d48
+Create Date: 2026-10-19 14:31:26.548102
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '8f3b6a2c1e57'
+down_revision = '7c5e92b16d48'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade(engine_name):
+    eval("upgrade_%s" % engine_name)()
+
+
+def downgrade(engine_name):
+    eval("downgrade_%s" % engine_name)()
+
+
+def upgrade_engine1():
+    op.create_table(
+        'site_health',
+        sa.Column(
+            'site_id',
+            sa.Integer,
+            sa.ForeignKey('sites.id', name='fk_site_health_site_id'),
+            primary_key=True
+        ),
+        sa.Column('failures', sa.Integer, default=0),
+        sa.Column('last_success', sa.DateTime),
+        sa.Column('last_failure', sa.DateTime),
+        sa.Column('last_error', sa.String(255)),
+        sa.Column('open_until', sa.DateTime)
+    )
+
+
+def downgrade_engine1():
+    op.drop_table('site_health')
@@ -0,0 +1,103 @@
+"""add site tokens
+
+Revision ID: 9b1c4e7a2d35
+Revises: 8f3b6a2c1e57
+Create Date: 2026-10-19 15:02:11.730465
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '9b1c4e7a2d35'
+down_revision = '8f3b6a2c1e57'
+
+from collections import defaultdict
+import json
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# Lightweight tables for moving tokens between the two layouts
+site_tokens = sa.sql.table(
+    'site_tokens',
+    sa.sql.column('site_id', sa.Integer),
+    sa.sql.column('service', sa.String),
+    sa.sql.column('token', sa.String)
+)
+
+sites = sa.sql.table(
+    'sites',
+    sa.sql.column('id', sa.Integer),
+    sa.sql.column('moodle_tokens', sa.String)
+)
+
+
+def upgrade(engine_name):
+    eval("upgrade_%s" % engine_name)()
+
+
+def downgrade(engine_name):
+    eval("downgrade_%s" % engine_name)()
+
+
+def upgrade_engine1():
+    op.create_table(
+        'site_tokens',
+        sa.Column(
+            'site_id',
+            sa.Integer,
+            sa.ForeignKey('sites.id', name='fk_site_tokens_site_id'),
+            primary_key=True
+        ),
+        sa.Column('service', sa.String(64), primary_key=True),
+        sa.Column('token', sa.String(128))
+    )
+    op.create_index('ix_site_tokens_service', 'site_tokens', ['service'])
+
+    # Get the connection to do some non-mapped queries
+    connection = op.get_bind()
+
+    # Copy every token out of the json column
+    rows = []
+    for site in connection.execute("SELECT id,moodle_tokens FROM sites;"):
+        try:
+            tokens = json.loads(site.moodle_tokens or '{}')
+        except ValueError:
+            continue
+
+        for service, token in tokens.items():
+            if token:
+                rows.append({'site_id': site.id,
+                             'service': service,
+                             'token': token})
+
+    if rows:
+        op.bulk_insert(site_tokens, rows)
+
+    op.drop_column('sites', 'moodle_tokens')
+
+
+def downgrade_engine1():
+    op.add_column(
+        'sites',
+        sa.Column('moodle_tokens', sa.String(2048), server_default="{}")
+    )
+
+    # Get the connection to do some non-mapped queries
+    connection = op.get_bind()
+
+    # site.id: tokens as {}
+    tokens = defaultdict(dict)
+    for row in connection.execute(
+        "SELECT site_id,service,token FROM site_tokens;"
+    ):
+        tokens[row.site_id][row.service] = row.token
+
+    for site_id, site_tokens_json in tokens.items():
+        connection.execute(
+            sites.update().where(sites.c.id == site_id).values(
+                moodle_tokens=json.dumps(site_tokens_json)
+            )
+        )
+
+    op.drop_table('site_tokens')
@@ -0,0 +1,49 @@
+"""add install slots
+
+Revision ID: b4d2e8f1a6c3
+Revises: 9b1c4e7a2d35
+Create Date: 2026-10-19 16:12:40.218305
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'b4d2e8f1a6c3'
+down_revision = '9b1c4e7a2d35'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# Lightweight table for clearing out the old slot counters
+counters = sa.sql.table(
+    'counters',
+    sa.sql.column('name', sa.String)
+)
+
+
+def upgrade(engine_name):
+    eval("upgrade_%s" % engine_name)()
+
+
+def downgrade(engine_name):
+    eval("downgrade_%s" % engine_name)()
+
+
+def upgrade_engine1():
+    op.create_table(
+        'install_slots',
+        sa.Column('host', sa.String(64), primary_key=True),
+        sa.Column('slot', sa.Integer, primary_key=True,
+                  autoincrement=False),
+        sa.Column('holder', sa.String(36)),
+        sa.Column('expires', sa.DateTime)
+    )
+
+    # Slots used to be counted in counters, which leases replace
+    op.execute(counters.delete().where(
+        counters.c.name.like('install_slots:%')
+    ))
+
+
+def downgrade_engine1():
+    op.drop_table('install_slots')
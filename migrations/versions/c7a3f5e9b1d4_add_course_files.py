@@ -0,0 +1,37 @@
+"""add course files
+
+Revision ID: c7a3f5e9b1d4
+Revises: b4d2e8f1a6c3
+Create Date: 2026-10-19 16:48:05.613927
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'c7a3f5e9b1d4'
+down_revision = 'b4d2e8f1a6c3'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade(engine_name):
+    eval("upgrade_%s" % engine_name)()
+
+
+def downgrade(engine_name):
+    eval("downgrade_%s" % engine_name)()
+
+
+def upgrade_engine1():
+    op.create_table(
+        'course_files',
+        sa.Column('path_hash', sa.String(40), primary_key=True),
+        sa.Column('path', sa.Text),
+        sa.Column('size', sa.BigInteger),
+        sa.Column('mtime', sa.BigInteger),
+        sa.Column('fingerprint', sa.String(64))
+    )
+
+
+def downgrade_engine1():
+    op.drop_table('course_files')
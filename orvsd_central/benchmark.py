@@ -0,0 +1,484 @@
+"""
+Synthetic data for, and timings of, the report queries, and load tests of
+collection and installs against a fake moodle. See the generate_data,
+benchmark and load_test commands in manage.py.
+"""
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+import json
+import logging
+from multiprocessing.pool import ThreadPool
+import random
+from threading import BoundedSemaphore
+import time
+
+from flask import current_app, g
+from sqlalchemy import event, func
+
+from orvsd_central.fakemoodle import fake_siteinfo
+from orvsd_central.models import (Course, District, InstallSlot, School,
+                                  Site, SiteCourse, SiteDetail, SiteHealth,
+                                  SiteToken)
+from orvsd_central.util import (add_sites, district_details,
+                                gather_siteinfo_shard, gather_tokens_shard,
+                                get_active_counts, get_schools,
+                                install_courses_to_site, interleave_by_host,
+                                remove_sites, site_host, site_install_url)
+
+# Synthetic districts and schools have state ids from here up, and synthetic
+# sites live under this domain, so they can be told apart and removed again
+SYNTHETIC_STATE_ID = 900000
+SYNTHETIC_DOMAIN = 'synthetic.invalid'
+
+
+def _insert(model, rows, chunk_size):
+    """
+    Inserts dicts of columns into 'model's table, chunk_size at a time.
+    """
+    for i in xrange(0, len(rows), chunk_size):
+        g.db_session.execute(model.__table__.insert(),
+                             rows[i:i + chunk_size])
+
+
+def generate_dataset(districts=20, schools=5, sites=2, details=10,
+                     courses=50, inactive=0.2, seed=None, chunk_size=1000):
+    """
+    Fills the database with synthetic districts, schools, sites and siteinfo
+    history, added to any synthetic data already there.
+
+    districts: number of districts
+    schools: schools per district
+    sites: sites per school, every fourth one a drupal site
+    details: SiteDetails per moodle site, one a day going back from now
+    courses: courses in the siteinfo payloads
+    inactive: share of moodle sites left without siteinfo
+    seed: seed for the random numbers, to repeat a dataset
+
+    Returns:
+        A dict of the number of rows created in each table.
+    """
+    rng = random.Random(seed)
+    now = datetime.now()
+
+    first_id = (g.db_session.query(func.max(District.state_id)).filter(
+        District.state_id >= SYNTHETIC_STATE_ID
+    ).scalar() or SYNTHETIC_STATE_ID - 1) + 1
+    first_school_id = (g.db_session.query(func.max(School.state_id)).filter(
+        School.state_id >= SYNTHETIC_STATE_ID
+    ).scalar() or SYNTHETIC_STATE_ID - 1) + 1
+
+    district_rows = [{'state_id': first_id + i,
+                      'name': 'Synthetic SD %d' % (first_id + i),
+                      'shortname': 'SyntheticSD%d' % (first_id + i)}
+                     for i in xrange(districts)]
+    _insert(District, district_rows, chunk_size)
+
+    district_ids = g.db_session.query(District.id).filter(
+        District.state_id >= first_id
+    ).order_by(District.state_id).all()
+
+    school_rows = []
+    for district_id, in district_ids:
+        for i in xrange(schools):
+            state_id = first_school_id + len(school_rows)
+            school_rows.append({
+                'district_id': district_id,
+                'state_id': state_id,
+                'name': 'Synthetic School %d' % state_id,
+                'shortname': 'SyntheticSchool%d' % state_id,
+                'domain': 's%d.%s' % (state_id, SYNTHETIC_DOMAIN),
+                'license': '',
+                'county': 'Synthetic'
+            })
+    _insert(School, school_rows, chunk_size)
+
+    school_ids = g.db_session.query(School.id, School.state_id).filter(
+        School.state_id >= first_school_id
+    ).order_by(School.state_id).all()
+
+    site_rows = []
+    for school_id, state_id in school_ids:
+        for i in xrange(sites):
+            site_rows.append({
+                'school_id': school_id,
+                'name': 'Synthetic Site %d-%d' % (state_id, i),
+                'dev': False,
+                'sitetype': 'drupal' if i % 4 == 3 else 'moodle',
+                'baseurl': 's%d-%d.%s' % (state_id, i, SYNTHETIC_DOMAIN),
+                'basepath': '/var/www/synthetic/s%d-%d/' % (state_id, i),
+                'location': 'synthetic%d' % (state_id % 4)
+            })
+    _insert(Site, site_rows, chunk_size)
+
+    new_sites = g.db_session.query(Site.id).filter(
+        Site.baseurl.in_([row['baseurl'] for row in site_rows]),
+        Site.sitetype == 'moodle'
+    ).all() if site_rows else []
+
+    detail_count = 0
+    for site_id, in new_sites:
+        if rng.random() < inactive:
+            continue
+
+        # One payload per site, its history differing only in the counts
+        info = fake_siteinfo(rng, courses)
+        adminlist = json.dumps(info['adminlist'])
+        rows = [dict(info,
+                     site_id=site_id,
+                     adminlist=adminlist,
+                     activeusers=max(info['activeusers'] - day, 0),
+                     timemodified=now - timedelta(days=day))
+                for day in xrange(details)]
+        _insert(SiteDetail, rows, chunk_size)
+        detail_count += len(rows)
+
+    g.db_session.commit()
+
+    return {'districts': len(district_rows),
+            'schools': len(school_rows),
+            'sites': len(site_rows),
+            'site_details': detail_count}
+
+
+def clear_dataset():
+    """
+    Removes the synthetic districts, schools, sites and their siteinfo.
+
+    Returns:
+        The number of synthetic sites removed.
+    """
+    site_ids = g.db_session.query(Site.id).filter(
+        Site.baseurl.like('%%.%s' % SYNTHETIC_DOMAIN)
+    ).subquery()
+
+    g.db_session.query(SiteDetail).filter(
+        SiteDetail.site_id.in_(site_ids)
+    ).delete(synchronize_session=False)
+    count = g.db_session.query(Site).filter(
+        Site.baseurl.like('%%.%s' % SYNTHETIC_DOMAIN)
+    ).delete(synchronize_session=False)
+    g.db_session.query(School).filter(
+        School.state_id >= SYNTHETIC_STATE_ID
+    ).delete(synchronize_session=False)
+    g.db_session.query(District).filter(
+        District.state_id >= SYNTHETIC_STATE_ID
+    ).delete(synchronize_session=False)
+
+    g.db_session.commit()
+    return count
+
+
+@contextmanager
+def count_queries(engine):
+    """
+    Counts the statements run on 'engine' within the block.
+
+    Yields:
+        A list holding the count.
+    """
+    count = [0]
+
+    def before_cursor_execute(*args):
+        count[0] += 1
+
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield count
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
+
+def _request(client, url):
+    """
+    Returns a callable requesting 'url' from the app, failing on an error.
+    """
+    def request():
+        resp = client.get(url)
+        if resp.status_code != 200:
+            raise RuntimeError("%s returned %d" % (url, resp.status_code))
+    return request
+
+
+def run_benchmarks(repeat=5):
+    """
+    Times the report queries and API calls against the district with the
+    most schools, each on a fresh session so nothing is served from it.
+
+    Returns:
+        A list of dicts with the 'name' of each benchmark, its 'min',
+        'median' and 'max' seconds over 'repeat' runs, and the number of
+        'queries' one run makes.
+    """
+    busiest = g.db_session.query(School.district_id).group_by(
+        School.district_id
+    ).order_by(func.count(School.id).desc()).first()
+    if busiest is None:
+        return []
+
+    dist_id = busiest[0]
+    client = current_app.test_client()
+
+    def details():
+        district_details(School.query.filter_by(district_id=dist_id).all(),
+                         True)
+
+    benchmarks = [
+        ('get_active_counts', get_active_counts),
+        ('get_schools active', lambda: get_schools(dist_id, True)),
+        ('get_schools inactive', lambda: get_schools(dist_id, False)),
+        ('district_details', details),
+        ('/1/report/stats', _request(client, '/1/report/stats')),
+        ('/1/report/get_active_schools',
+         _request(client, '/1/report/get_active_schools?distid=%d' %
+                  dist_id)),
+        ('/1/report/get_inactive_schools',
+         _request(client, '/1/report/get_inactive_schools?distid=%d' %
+                  dist_id)),
+        ('/1/districts/active', _request(client, '/1/districts/active'))
+    ]
+
+    engine = g.db_session.get_bind()
+    results = []
+    for name, benchmark in benchmarks:
+        timings = []
+        for i in xrange(repeat):
+            g.db_session.remove()
+            with count_queries(engine) as queries:
+                start = time.time()
+                benchmark()
+                timings.append(time.time() - start)
+
+        timings.sort()
+        results.append({'name': name,
+                        'min': timings[0],
+                        'median': timings[len(timings) // 2],
+                        'max': timings[-1],
+                        'queries': queries[0]})
+
+    return results
+
+
+# Sites and courses made for a load test are at this path on the fake moodle
+# and from this source, so they can be told apart and removed again
+LOAD_TEST_PATH = 'loadtest'
+
+
+def _apply_task(job):
+    """
+    Runs a celery task in this thread with apply(), as a worker would run
+    it. This runs in a worker thread of run_load_test, with its own app
+    context and its own session of the caller's scoped session. A job with a
+    semaphore holds it while the task runs.
+
+    Returns:
+        The task's EagerResult.
+    """
+    app, db_session, task, args, semaphore = job
+
+    if semaphore:
+        semaphore.acquire()
+    try:
+        with app.app_context():
+            g.db_session = db_session
+            return task.apply(args=args)
+    finally:
+        if semaphore:
+            semaphore.release()
+
+
+def _apply_tasks(workers, task, args_list, semaphores=None):
+    """
+    Runs 'task' once for every tuple of arguments in 'args_list', 'workers'
+    at a time and in order. 'semaphores' gives the semaphore each of the
+    tasks holds while it runs, if any.
+
+    The tasks commit in sessions of their own, so the caller's transaction
+    is ended before they start, to hold no locks they wait on, and again
+    once they are done, to see what they committed.
+
+    Returns:
+        The number of tasks that raised an exception, each of which is
+        logged.
+    """
+    app = current_app._get_current_object()
+    semaphores = semaphores or [None] * len(args_list)
+    jobs = [(app, g.db_session, task, args, semaphore)
+            for args, semaphore in zip(args_list, semaphores)]
+    if not jobs:
+        return 0
+
+    g.db_session.rollback()
+    pool = ThreadPool(max(min(workers, len(jobs)), 1))
+    try:
+        # One at a time, so tasks start in the order they were queued
+        results = list(pool.imap(_apply_task, jobs, 1))
+    finally:
+        pool.close()
+        pool.join()
+        g.db_session.rollback()
+
+    failed = [result for result in results if result.failed()]
+    for result in failed:
+        logging.error("%s failed:\n%s" % (task.name, result.traceback))
+    return len(failed)
+
+
+def _remove_install_slots(hosts):
+    """
+    Removes the install slots of 'hosts', held or not. The caller commits.
+    """
+    g.db_session.query(InstallSlot).filter(
+        InstallSlot.host.in_(hosts)
+    ).delete(synchronize_session=False)
+
+
+@contextmanager
+def _config(**changes):
+    """
+    Changes the app config while the block runs.
+    """
+    config = current_app.config
+    saved = dict((key, config.get(key)) for key in changes)
+    config.update(changes)
+    try:
+        yield
+    finally:
+        config.update(saved)
+
+
+def run_load_test(server, sites=50, install_courses=5, workers=4,
+                  hosts=None, timeout=None):
+    """
+    Runs the real collection and install tasks for 'sites' temporary sites
+    served by the fake moodle at 'server', a host:port. Tokens and siteinfo
+    are gathered by the shard tasks of the collection sweeps, and courses are
+    installed by install_courses_to_site, so install slots, circuit breakers,
+    retries and failed install records all take part. The sites, courses and
+    everything recorded for them are removed afterwards.
+
+    The tasks run in this process with apply(), which carries out a retry
+    straight away instead of after its countdown. So that a busy host is not
+    retried over and over, no more install tasks run against a host at once
+    than it has install slots, the rest waiting their turn as they would in
+    the queue.
+
+    install_courses: courses to install to every site
+    workers: tasks run at once, like celery workers would
+    hosts: hosts the sites are spread over, each with INSTALL_MAX_PER_HOST
+        install slots. Every site is its own host by default.
+    timeout: seconds to wait for a site to answer, instead of the
+        configured read timeouts
+
+    Returns:
+        A list of dicts with the 'name' of each step, the 'seconds' it took,
+        how many sites or installs were 'ok' and 'failed', and how many of
+        its tasks raised 'errors'.
+    """
+    config = current_app.config
+    changes = {'MOODLE_SERVICES': ['orvsd_siteinfo', 'orvsd_installcourse']}
+    if timeout:
+        changes['COLLECTION_READ_TIMEOUT'] = timeout
+        changes['INSTALL_READ_TIMEOUT'] = timeout
+
+    host_names = ['%s-host-%d' % (LOAD_TEST_PATH, i)
+                  for i in xrange(hosts or sites)]
+    # Slots still held by a load test that was killed
+    _remove_install_slots(host_names)
+
+    base_urls = ['%s/%s-%d' % (server, LOAD_TEST_PATH, i)
+                 for i in xrange(sites)]
+    site_ids = add_sites([{'name': 'Load Test %d' % i,
+                           'sitetype': 'moodle',
+                           'baseurl': base_url,
+                           'basepath': '',
+                           'location': host_names[i % len(host_names)]}
+                          for i, base_url in enumerate(base_urls)])
+
+    courses = [Course(name='Load Test Course %d' % i,
+                      shortname='LOADTEST%d' % i,
+                      source=LOAD_TEST_PATH,
+                      filename='%s%d.mbz' % (LOAD_TEST_PATH, i))
+               for i in xrange(install_courses)]
+    g.db_session.add_all(courses)
+    g.db_session.commit()
+    course_ids = [course.id for course in courses]
+
+    size = config.get('COLLECTION_SHARD_SIZE', 25)
+    shards = [(site_ids[i:i + size],) for i in xrange(0, len(site_ids), size)]
+
+    results = []
+    try:
+        with _config(**changes):
+            start = time.time()
+            errors = _apply_tasks(workers, gather_tokens_shard, shards)
+            with_tokens = g.db_session.query(SiteToken.site_id).filter(
+                SiteToken.site_id.in_(site_ids),
+                SiteToken.service.in_(changes['MOODLE_SERVICES'])
+            ).group_by(SiteToken.site_id).having(
+                func.count(SiteToken.service) == 2
+            ).count()
+            results.append({'name': 'tokens',
+                            'seconds': time.time() - start,
+                            'ok': with_tokens,
+                            'failed': sites - with_tokens,
+                            'errors': errors})
+
+            start = time.time()
+            errors = _apply_tasks(workers, gather_siteinfo_shard, shards)
+            gathered = g.db_session.query(
+                func.count(func.distinct(SiteDetail.site_id))
+            ).filter(SiteDetail.site_id.in_(site_ids)).scalar()
+            results.append({'name': 'siteinfo',
+                            'seconds': time.time() - start,
+                            'ok': gathered,
+                            'failed': sites - gathered,
+                            'errors': errors})
+
+            site_list = interleave_by_host([
+                site for site in Site.query.filter(Site.id.in_(site_ids))
+                if site.get_token('orvsd_installcourse')
+            ])
+            installs = [(site.id, course_ids, site_install_url(site))
+                        for site in site_list]
+            slots = dict((site_host(site), BoundedSemaphore(
+                config.get('INSTALL_MAX_PER_HOST', 2)
+            )) for site in site_list)
+
+            start = time.time()
+            errors = _apply_tasks(
+                workers, install_courses_to_site, installs,
+                [slots[site_host(site)] for site in site_list]
+            )
+            installed = SiteCourse.query.filter(
+                SiteCourse.site_id.in_(site_ids),
+                SiteCourse.active == True
+            ).count()
+            # Not only the FailedInstalls, a task that raised records none
+            results.append({'name': 'installs',
+                            'seconds': time.time() - start,
+                            'ok': installed,
+                            'failed': (len(installs) * len(course_ids) -
+                                       installed),
+                            'errors': errors})
+
+        results.append({'name': 'open circuits',
+                        'seconds': 0,
+                        'ok': 0,
+                        'failed': SiteHealth.query.filter(
+                            SiteHealth.site_id.in_(site_ids),
+                            SiteHealth.open_until > datetime.now()
+                        ).count(),
+                        'errors': 0})
+    finally:
+        g.db_session.rollback()
+        g.db_session.query(SiteDetail).filter(
+            SiteDetail.site_id.in_(site_ids)
+        ).delete(synchronize_session=False)
+        remove_sites(base_urls)
+        g.db_session.query(Course).filter(
+            Course.id.in_(course_ids)
+        ).delete(synchronize_session=False)
+        _remove_install_slots(host_names)
+        g.db_session.commit()
+
+    return results
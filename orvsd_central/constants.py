@@ -1,2 +1,10 @@
 # Defined user permission levels.
 USER_PERMS = {'viewonly': 1, 'helpdesk': 2, 'admin': 3}
+
+# Named counter used to hand out course serials, and the first serial given.
+COURSE_SERIAL_COUNTER = 'course_serial'
+COURSE_SERIAL_START = 1000
+
+# Celery queue for one-off actions an operator is waiting on. Everything
+# else is routed by CELERY_ROUTES.
+INTERACTIVE_QUEUE = 'interactive'
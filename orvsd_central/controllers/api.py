@@ -1,15 +1,29 @@
+from datetime import datetime
 import json
+import time
 
-from flask import Blueprint, abort, g, jsonify, request
+from celery import states
+from celery.backends.database.models import Task as TaskMeta
+from flask import (Blueprint, Response, abort, current_app, g, jsonify,
+                   request, stream_with_context)
 
-from orvsd_central.models import Course, District, School, Site, SiteDetail
-from orvsd_central.util import (get_obj_by_category, get_obj_identifier,
-                                get_active_counts, get_schools, string_to_type,
-                                gather_tokens, gather_siteinfo)
+from orvsd_central.models import (Course, District, InstallTask, School, Site,
+                                  SiteDetail, SiteHealth, TaskSummary)
+from orvsd_central.util import (course_search_query, get_obj_by_category,
+                                get_obj_identifier, get_active_counts,
+                                get_schools, index_courses,
+                                install_task_summaries,
+                                invalidate_moodle_site_index, search_courses,
+                                sites_missing_token, string_to_type,
+                                gather_tokens, gather_siteinfo, task_states,
+                                token_coverage, unindex_courses)
 
 
 mod = Blueprint('api', __name__, url_prefix="/1")
 
+# Install task states after which nothing more will happen
+FINAL_STATES = states.READY_STATES | frozenset(['MISSING'])
+
 
 @mod.route("/districts/active", methods=['GET'])
 def active_districts():
@@ -49,6 +63,10 @@ def add_object(category):
         g.db_session.add(obj)
         g.db_session.commit()
 
+        if isinstance(obj, Course):
+            index_courses([obj])
+            g.db_session.commit()
+
         if isinstance(obj, Site):
             gather_tokens(obj)
             gather_siteinfo(obj)
@@ -70,6 +88,8 @@ def delete_object(category, id):
     if obj:
         modified_obj = obj.query.filter_by(id=request.form.get("id")).first()
         if modified_obj:
+            if isinstance(modified_obj, Course):
+                unindex_courses([modified_obj.id])
             g.db_session.delete(modified_obj)
             g.db_session.commit()
             return jsonify({'message': "Object deleted successfully!"})
@@ -77,20 +97,153 @@ def delete_object(category, id):
     abort(404)
 
 
-# Get all task IDs
-# TODO: Needs testing
+def _parse_time(value):
+    """
+    Parses a 'YYYY-MM-DD' or 'YYYY-MM-DDTHH:MM:SS' argument, aborting the
+    request if it is neither.
+    """
+    for fmt in ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%d'):
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    abort(400)
+
+
 @mod.route('/celery/id/all')
 def get_all_ids():
     """
-    Returns JSONified metadata for all celery tasks.
-    """
-    # TODO: "result" is another column, but SQLAlchemy
-    # complains of some encoding error.
-    statuses = g.db_session.query(
-        "id", "task_id", "status", "date_done", "traceback"
-    ).from_statement("SELECT * FROM celery_taskmeta").all()
+    Returns JSONified metadata for a page of celery tasks, oldest first.
 
-    return jsonify(status=statuses)
+    Pages are selected by the 'after' argument, the id of the last task of
+    the previous page, which is returned as 'next' while there are more.
+    'limit' sets the page size, and 'status', 'since' and 'until' (matched
+    against date_done) narrow down the tasks.
+    """
+    after = request.args.get('after', 0, type=int)
+    limit = min(max(request.args.get('limit', 100, type=int), 1), 1000)
+
+    # "result" holds bulky pickled data, so it is left out
+    query = g.db_session.query(
+        TaskMeta.id, TaskMeta.task_id, TaskMeta.status, TaskMeta.date_done,
+        TaskMeta.traceback
+    ).filter(TaskMeta.id > after)
+
+    if request.args.get('status'):
+        query = query.filter(TaskMeta.status == request.args['status'])
+    if request.args.get('since'):
+        query = query.filter(
+            TaskMeta.date_done >= _parse_time(request.args['since'])
+        )
+    if request.args.get('until'):
+        query = query.filter(
+            TaskMeta.date_done < _parse_time(request.args['until'])
+        )
+
+    statuses = query.order_by(TaskMeta.id).limit(limit).all()
+
+    return jsonify(
+        status=statuses,
+        next=statuses[-1].id if len(statuses) == limit else None
+    )
+
+
+@mod.route('/celery/status', methods=['GET', 'POST'])
+def get_task_statuses():
+    """
+    Returns JSONified statuses of every celery task listed in the 'id'
+    arguments, looked up in a single query, plus one for any compacted by
+    compact_task_results. Tasks without a result yet are reported as
+    PENDING.
+    """
+    task_ids = request.values.getlist('id')
+    metas = task_states(task_ids)
+
+    # Old results may have been compacted into summaries
+    missing = [task_id for task_id in task_ids if task_id not in metas]
+    if missing:
+        metas.update(
+            (summary.task_id, summary) for summary in TaskSummary.query.filter(
+                TaskSummary.task_id.in_(missing)
+            )
+        )
+
+    statuses = {}
+    for task_id in task_ids:
+        meta = metas.get(task_id)
+        statuses[task_id] = {
+            'status': meta.status if meta else 'PENDING',
+            'date_done': meta.date_done if meta else None
+        }
+
+    return jsonify(statuses=statuses)
+
+
+@mod.route('/installs/<batch>/events')
+def install_events(batch):
+    """
+    Streams the progress of every install task in a rollout as Server-Sent
+    Events.
+
+    The states of all the rollout's tasks are looked up together every
+    INSTALL_EVENTS_INTERVAL seconds, and a 'task' event carrying the
+    task_id, site_id and a summary of its state is sent whenever one
+    changes. A 'done' event is sent once every task has finished, or its
+    result is gone.
+
+    So a stuck rollout can't hold a worker for good, a 'timeout' event with
+    the site_ids of the unfinished tasks ends the stream when no task has
+    changed for INSTALL_EVENTS_IDLE_TIMEOUT seconds, or after
+    INSTALL_EVENTS_MAX_DURATION seconds in all.
+    """
+    tasks = InstallTask.query.filter_by(batch=batch).all()
+    if not tasks:
+        abort(404)
+
+    # Plain values, as every rollback below would expire the InstallTasks
+    sites = dict((task.task_id, task.site_id) for task in tasks)
+    queued = dict((task.task_id, task.queued) for task in tasks)
+    config = current_app.config
+    interval = config.get('INSTALL_EVENTS_INTERVAL', 2)
+    idle_timeout = config.get('INSTALL_EVENTS_IDLE_TIMEOUT', 900)
+    max_duration = config.get('INSTALL_EVENTS_MAX_DURATION', 3600)
+
+    def events():
+        last = {}
+        started = changed = time.time()
+        while True:
+            # End the last transaction so the workers' updates are visible
+            g.db_session.rollback()
+            summaries = install_task_summaries(queued)
+
+            for task_id, site_id in sites.iteritems():
+                summary = summaries[task_id]
+                if summary != last.get(task_id):
+                    last[task_id] = summary
+                    changed = time.time()
+                    data = dict(summary, task_id=task_id, site_id=site_id)
+                    yield "event: task\ndata: %s\n\n" % json.dumps(data)
+
+            unfinished = [task_id for task_id, s in last.iteritems()
+                          if s['status'] not in FINAL_STATES]
+            if not unfinished:
+                yield "event: done\ndata: {}\n\n"
+                return
+
+            now = time.time()
+            if now - changed > idle_timeout or now - started > max_duration:
+                data = {'site_ids': [sites[task_id] for task_id in unfinished]}
+                yield "event: timeout\ndata: %s\n\n" % json.dumps(data)
+                return
+
+            # Keeps proxies from closing a quiet connection
+            yield ": waiting\n\n"
+            time.sleep(interval)
+
+    return Response(stream_with_context(events()),
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache',
+                             'X-Accel-Buffering': 'no'})
 
 
 @mod.route("/<category>/<id>/update", methods=["POST"])
@@ -114,8 +267,15 @@ def update_object(category, id):
             g.db_session.query(obj).filter_by(
                 id=request.form.get("id")
             ).update(inputs)
+
+            if isinstance(modified_obj, Course):
+                index_courses([modified_obj])
             g.db_session.commit()
 
+            # A site's baseurl or type may have changed
+            if isinstance(modified_obj, Site):
+                invalidate_moodle_site_index()
+
             return jsonify({'identifier': identifier,
                             identifier: inputs[identifier],
                             'message': "Object updated successfully!"})
@@ -151,28 +311,46 @@ def get_course_list():
     provided in the 'filter' form element.
     """
     dir = request.form.get('filter')
+    query = Course.query.order_by(Course.name, Course.id)
 
     if dir == "None":
-        courses = Course.query.all()
+        courses = query.all()
     else:
-        courses = g.db_session.query(Course).filter(
-            Course.source == dir
-        ).all()
+        courses = query.filter(Course.source == dir).all()
 
     # This means the folder selected was not the source folder or None.
     if not courses:
-        courses = g.db_session.query(Course).filter(
-            Course.filename.like("%" + dir + "%")
-        ).all()
-
-    courses = sorted(courses, key=lambda x: x.course.name)
-
-    serialized_courses = [{'id': course.course_id,
-                           'name': course.course.name}
+        # The search index narrows the catalog down to courses mentioning the
+        # folder, of which we keep those actually stored in it.
+        candidates = course_search_query(dir).order_by(Course.name, Course.id)
+        courses = [course for course in candidates
+                   if dir in (course.filename or '').split('/')[:-1]]
+
+    serialized_courses = [{'id': course.id,
+                           'name': course.name}
                           for course in courses]
     return jsonify(courses=serialized_courses)
 
 
+@mod.route("/courses/search", methods=["GET"])
+def search_course_list():
+    """
+    Returns a JSONified page of courses whose name, shortname, source or
+    filename contain every word of the 'q' argument, sorted by name.
+
+    The 'page' and 'per_page' arguments select the page of results.
+    """
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = min(max(request.args.get('per_page', 50, type=int), 1), 500)
+
+    total, courses = search_courses(request.args.get('q', ''), page, per_page)
+
+    return jsonify(total=total,
+                   page=page,
+                   per_page=per_page,
+                   courses=[course.serialize() for course in courses])
+
+
 @mod.route("/<category>/keys")
 def get_keys(category):
     """
@@ -185,6 +363,54 @@ def get_keys(category):
         return jsonify(cols)
 
 
+@mod.route("/site/<int:site_id>/health")
+def get_site_health(site_id):
+    """
+    Returns the JSONified health of remote calls to a site, see SiteHealth.
+    """
+    health = SiteHealth.query.get(site_id)
+    if health:
+        return jsonify(health.serialize())
+    elif Site.query.get(site_id):
+        # Nothing has been recorded for the site yet
+        return jsonify({'site_id': site_id, 'failures': 0, 'open': False})
+
+    abort(404)
+
+
+@mod.route("/sites/health")
+def get_sites_health():
+    """
+    Returns the JSONified health of every site with failed remote calls,
+    sites with an open circuit first.
+    """
+    failing = SiteHealth.query.filter(
+        SiteHealth.failures > 0
+    ).order_by(SiteHealth.open_until.desc(), SiteHealth.failures.desc())
+
+    return jsonify(sites=[health.serialize() for health in failing])
+
+
+@mod.route("/sites/tokens")
+def get_sites_tokens():
+    """
+    Returns a JSONified count of the moodle sites with and without a token
+    for each service in MOODLE_SERVICES.
+    """
+    return jsonify(token_coverage())
+
+
+@mod.route("/sites/tokens/<service>/missing")
+def get_sites_missing_token(service):
+    """
+    Returns a JSONified list of moodle site ids and names for sites without
+    a token for 'service'.
+    """
+    data = [{'id': site.id, 'name': site.name}
+            for site in sites_missing_token(service)]
+    return jsonify(content=data)
+
+
 @mod.route("/site/<baseurl>/moodle")
 def get_moodle_sites(baseurl):
     """
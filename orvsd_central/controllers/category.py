@@ -7,12 +7,14 @@ from flask.ext.login import current_user, login_required
 from sqlalchemy import and_
 
 from orvsd_central.forms import InstallCourse
-from orvsd_central.models import (Course, District, School, Site, SiteCourse,
-                                  SiteDetail)
-from orvsd_central.util import (create_course_from_moodle_backup,
+from orvsd_central.models import Course, District, School, Site, SiteDetail
+from orvsd_central.util import (allocate_course_serials,
+                                create_course_from_moodle_backup,
+                                fingerprint_files,
                                 get_course_folders, get_path_and_source,
                                 get_obj_by_category, get_obj_identifier,
-                                install_course_to_site, requires_role)
+                                invalidate_course_folders, moodle_site_index,
+                                plan_installs, queue_installs, requires_role)
 
 mod = Blueprint('category', __name__)
 
@@ -72,24 +74,6 @@ def install_course():
             .like('2%')
             ).all()
 
-        # Query all moodle sites
-        sites = g.db_session.query(Site).filter(
-            Site.sitetype == 'moodle')
-
-        moodle_2_sites = []
-
-        # For all sites query the SiteDetail to see if it's a moodle 2.x site
-        for site in sites:
-            details = g.db_session.query(SiteDetail).filter(
-                and_(
-                    SiteDetail.site_id == site.id,
-                    SiteDetail.siterelease.like('2%')
-                )
-            ).order_by(SiteDetail.timemodified.desc()).first()
-
-            if details is not None:
-                moodle_2_sites.append(site)
-
         # Generate the list of choices for the template
         courses_info = []
         sites_info = []
@@ -108,9 +92,10 @@ def install_course():
                          (course.name)))
                 listed_courses.append(course.id)
 
-        # Create the sites list
-        for site in moodle_2_sites:
-            sites_info.append((site.id, site.baseurl))
+        # Create the sites list from the moodle 2.x sites
+        for site_id, baseurl, release in moodle_site_index():
+            if release == '2':
+                sites_info.append((site_id, baseurl))
 
         form.course.choices = sorted(courses_info, key=lambda x: x[1])
         form.site.choices = sorted(sites_info, key=lambda x: x[1])
@@ -130,39 +115,46 @@ def install_course():
         # An array of unicode strings will be passed, they need to be integers
         # for the query
         selected_courses = [int(cid) for cid in request.form.getlist('course')]
-        site_ids = [site_id for site_id in request.form.getlist('site')]
-        sites = [Site.query.filter_by(id=site).first() for site in site_ids]
+        site_ids = [int(sid) for sid in request.form.getlist('site')]
+
+        sites = g.db_session.query(Site).filter(
+            Site.id.in_(site_ids)
+        ).all() if site_ids else []
 
         course_details = g.db_session.query(Course).filter(
             Course.id.in_(selected_courses)
-        ).all()
-
-        for site in sites:
-            # The site to install the courses
-            install_url = ("http://%s/webservice/rest/server.php?" +
-                           "wstoken=%s&wsfunction=%s") % (
-                        site.baseurl,
-                        site.get_token('orvsd_installcourse'),
-                        current_app.config['INSTALL_COURSE_WS_FUNCTION'])
-            install_url = str(install_url.encode('utf-8'))
-
-            # Loop through the courses, generate the command to be run, run it,
-            # and append the ouput to output
-            #
-            # Currently this will break as our db is not setup correctly yet
-            for course_detail in course_details:
-                res = install_course_to_site.delay(
-                    course_detail.id, install_url
-                )
-                result_data = SiteCourse(site.id, course_detail.id, res.id)
-                g.db_session.add(result_data)
-                g.db_session.commit()
-
-            output += (str(len(course_details)) + " course install(s) for " +
-                       site.name + " started.\n")
+        ).order_by(Course.name).all() if selected_courses else []
+
+        # Only the courses sites don't have yet get installed
+        plan = plan_installs(sites, course_details)
+
+        # Show what would happen before queuing anything
+        if not request.form.get('confirm'):
+            return render_template('install_course_plan.html',
+                                   plan=plan,
+                                   site_ids=site_ids,
+                                   course_ids=selected_courses,
+                                   user=current_user)
+
+        # The plan alternates between hosts so a rollout keeps every server
+        # busy. One task installs all of the courses to a site, recording
+        # them as SiteCourses once it is done.
+        batch = queue_installs([
+            (entry['site'], [course.id for course in entry['install']])
+            for entry in plan if entry['install']
+        ])
+
+        for entry in plan:
+            output += ("%d course install(s) for %s started, %d already "
+                       "installed.\n" % (len(entry['install']),
+                                         entry['site'].name,
+                                         len(entry['skip'])))
 
         return render_template('install_course_output.html',
                                output=output,
+                               batch=batch,
+                               sites=[entry['site'] for entry in plan
+                                      if entry['install']],
                                user=current_user)
 
 
@@ -189,25 +181,70 @@ def update_courselist():
                     if os.path.isfile(full_file_path):
                         mdl_files.append(full_file_path)
 
-            filenames = []
-            sources = []
+            files = []
             for filename in mdl_files:
                 source, path = get_path_and_source(base_path, filename)
-                sources.append(source)
-                filenames.append(path)
+                files.append((source, path, filename))
 
-            courses = g.db_session.query(Course).filter(
-                Course.filename.in_(filenames)
-            ).all()
-
-            for course in courses:
-                if course.filename in filenames:
-                    sources.pop(filenames.index(course.filename))
-                    filenames.pop(filenames.index(course.filename))
+            courses = dict(
+                (course.filename, course)
+                for course in g.db_session.query(Course).filter(
+                    Course.filename.in_([path for _, path, _ in files])
+                )
+            ) if files else {}
+
+            # Only files that aren't cataloged yet, or were cataloged before
+            # fingerprinting, are fingerprinted. Fingerprints of unchanged
+            # files are reused from earlier scans.
+            new_files = [(source, path, full_path)
+                         for source, path, full_path in files
+                         if path not in courses]
+            unprinted = [(courses[path], full_path)
+                         for _, path, full_path in files
+                         if path in courses and
+                         courses[path].fingerprint is None]
+            fingerprints = fingerprint_files(
+                [full_path for _, _, full_path in new_files] +
+                [full_path for _, full_path in unprinted]
+            )
 
-            for source, file_path in zip(sources, filenames):
-                create_course_from_moodle_backup(base_path, source, file_path)
-                num_courses += 1
+            # Courses cataloged before fingerprinting get theirs now, so
+            # copies of them are recognised below.
+            for course, full_path in unprinted:
+                course.fingerprint = fingerprints[full_path]
+            g.db_session.flush()
+
+            # Archives already in the catalog under another name, and second
+            # copies found by this scan, are skipped before any serials are
+            # reserved for them.
+            known = set(fingerprint for fingerprint, in g.db_session.query(
+                Course.fingerprint
+            ).filter(Course.fingerprint.in_(
+                set(fingerprints[full_path] for _, _, full_path in new_files)
+            ))) if new_files else set()
+
+            to_create = []
+            for source, path, full_path in new_files:
+                if fingerprints[full_path] not in known:
+                    known.add(fingerprints[full_path])
+                    to_create.append((source, path, fingerprints[full_path]))
+
+            # Reserve serials for every new file in one round trip, and
+            # release the counter's lock before the slow unzipping begins.
+            # This also stores the fingerprints for the next scan.
+            serials = (allocate_course_serials(len(to_create))
+                       if to_create else [])
+            g.db_session.commit()
+
+            for (source, file_path, fingerprint), serial in zip(to_create,
+                                                                serials):
+                if create_course_from_moodle_backup(
+                    base_path, source, file_path, serial, fingerprint
+                ):
+                    num_courses += 1
+
+            # The scan may have turned up new folders for the install page
+            invalidate_course_folders(base_path)
 
             if num_courses > 0:
                 flash(
@@ -1,7 +1,7 @@
 import os
 
 from flask import current_app, g
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.orm import scoped_session, sessionmaker
 from sqlalchemy.exc import IntegrityError, ProgrammingError
 
@@ -14,6 +14,9 @@ def create_db_session():
     _db_address = current_app.config['SQLALCHEMY_DATABASE_URI']
 
     engine = create_engine(_db_address, convert_unicode=True)
+    if engine.dialect.name == 'sqlite':
+        enable_sqlite_savepoints(engine)
+
     db_session = scoped_session(sessionmaker(autocommit=False,
                                              autoflush=False,
                                              bind=engine))
@@ -21,6 +24,21 @@ def create_db_session():
     return db_session
 
 
+def enable_sqlite_savepoints(engine):
+    """
+    pysqlite starts transactions itself, and not before a SAVEPOINT, so
+    begin_nested() fails with "no such savepoint". Leaves starting them to
+    SQLAlchemy instead, as its SQLite documentation recommends.
+    """
+    @event.listens_for(engine, 'connect')
+    def connect(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(engine, 'begin')
+    def begin(connection):
+        connection.execute('BEGIN')
+
+
 def create_admin_account(silent):
     """
     command 'create_admin'
@@ -0,0 +1,210 @@
+"""
+A stand-in for the moodle webservices ORVSD Central calls, for load testing
+collection and installs without real sites. See the fake_moodle and
+load_test commands in manage.py.
+
+Any number of sites can share one server, as only the end of the path is
+looked at: http://127.0.0.1:8765/site-1/login/token.php and
+http://127.0.0.1:8765/site-2/login/token.php are two sites.
+"""
+import hashlib
+import json
+import random
+import threading
+import time
+
+from werkzeug.serving import WSGIRequestHandler, make_server
+from werkzeug.wrappers import Request, Response
+
+FIRST_NAMES = ['Alex', 'Casey', 'Jordan', 'Morgan', 'Riley', 'Sam', 'Taylor']
+LAST_NAMES = ['Baker', 'Garcia', 'Lee', 'Nguyen', 'Smith', 'Walker']
+SUBJECTS = ['Algebra', 'Biology', 'Chemistry', 'Civics', 'Geometry',
+            'Health', 'Literature', 'Physics', 'Spanish', 'World History']
+
+SITEINFO_FUNCTION = 'local_orvsd_siteinfo_siteinfo'
+
+INSTALL_RESPONSE = ('<?xml version="1.0" encoding="UTF-8" ?>\n'
+                    '<RESPONSE>\n<VALUE>%s installed</VALUE>\n</RESPONSE>\n')
+
+EXCEPTION_RESPONSE = ('<?xml version="1.0" encoding="UTF-8" ?>\n'
+                      '<EXCEPTION class="%s">\n<MESSAGE>%s</MESSAGE>\n'
+                      '</EXCEPTION>\n')
+
+
+def fake_siteinfo(rng, courses=50, admins=3):
+    """
+    Builds a siteinfo payload shaped like the one the orvsd_siteinfo moodle
+    plugin returns, with 'courses' courses and 'admins' admins.
+    """
+    course_list = []
+    for i in xrange(courses):
+        subject = rng.choice(SUBJECTS)
+        course_list.append({
+            'id': i + 2,
+            'serial': str(1000 + rng.randint(0, 5000)),
+            'shortname': '%s %d' % (subject[:4].upper(), i),
+            'fullname': '%s %d, %s' % (subject, rng.randint(1, 4),
+                                       rng.choice(['A', 'B', 'Honors'])),
+            'enrolled': rng.randint(0, 120),
+            'timecreated': rng.randint(1262304000, 1420070400)
+        })
+
+    adminlist = []
+    for i in xrange(admins):
+        first, last = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+        adminlist.append({'username': '%s%s%d' % (first[0], last, i),
+                          'firstname': first,
+                          'lastname': last,
+                          'email': '%s.%s@example.org' % (first, last)})
+
+    totalusers = rng.randint(50, 2000)
+    return {
+        'siteversion': '2012120300',
+        'siterelease': '2.4 (Build: 20121203)',
+        'adminlist': adminlist,
+        'adminusers': admins,
+        'teachers': rng.randint(1, 80),
+        'totalusers': totalusers,
+        'activeusers': rng.randint(0, totalusers),
+        'totalcourses': courses,
+        'courses': json.dumps(course_list)
+    }
+
+
+class FakeMoodle(object):
+    """
+    A WSGI app answering /login/token.php and /webservice/rest/server.php
+    like a site with the orvsd_siteinfo and orvsd_installcourse plugins.
+
+    latency      : Seconds every request takes
+    jitter       : Up to this many seconds more, at random
+    error_rate   : Share of requests answered with a 503
+    hang_rate    : Share of requests that hang for 'hang' seconds
+    hang         : Seconds a hanging request takes before it is answered
+    courses      : Courses in each siteinfo
+    install_time : Seconds a course install takes, on top of the latency
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0,
+                 hang_rate=0.0, hang=3600, courses=50, install_time=0.0,
+                 seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.hang_rate = hang_rate
+        self.hang = hang
+        self.courses = courses
+        self.install_time = install_time
+        self.rng = random.Random(seed)
+
+        # What the server was asked and how it answered, see count
+        self.stats = {}
+        self._lock = threading.Lock()
+
+    def count(self, key):
+        with self._lock:
+            self.stats[key] = self.stats.get(key, 0) + 1
+
+    def __call__(self, environ, start_response):
+        return self.dispatch(Request(environ))(environ, start_response)
+
+    def dispatch(self, request):
+        if request.path.endswith('/login/token.php'):
+            endpoint = self.token
+        elif request.path.endswith('/webservice/rest/server.php'):
+            endpoint = self.webservice
+        else:
+            return Response('Not found', status=404)
+
+        self.count('requests')
+        roll = self.rng.random()
+
+        if roll < self.hang_rate:
+            self.count('hung')
+            time.sleep(self.hang)
+        else:
+            time.sleep(self.latency + self.rng.uniform(0, self.jitter))
+
+        if roll >= 1 - self.error_rate:
+            self.count('errors')
+            return Response('Service Unavailable', status=503)
+
+        return endpoint(request)
+
+    def token(self, request):
+        """
+        Hands out a token per site and service, the same one every time.
+        """
+        service = request.values.get('service')
+        if not service or not request.values.get('username'):
+            return self.json({'error': 'Invalid login, please try again'})
+
+        self.count('tokens')
+        site = request.path[:-len('/login/token.php')]
+        return self.json({
+            'token': hashlib.md5('%s:%s' % (site, service)).hexdigest()
+        })
+
+    def webservice(self, request):
+        function = request.values.get('wsfunction')
+        json_format = request.values.get('moodlewsrestformat') == 'json'
+
+        if not request.values.get('wstoken'):
+            return self.exception('webservice_access_exception',
+                                  'Invalid token', json_format)
+
+        if function == SITEINFO_FUNCTION:
+            self.count('siteinfo')
+            return self.json(fake_siteinfo(self.rng, self.courses))
+
+        if function and 'installcourse' in function:
+            time.sleep(self.install_time)
+            self.count('installs')
+            return Response(INSTALL_RESPONSE %
+                            request.values.get('shortname', 'Course'),
+                            mimetype='application/xml')
+
+        return self.exception('invalid_parameter_exception',
+                              'Unknown function %s' % function, json_format)
+
+    def json(self, data):
+        return Response(json.dumps(data), mimetype='application/json')
+
+    def exception(self, name, message, json_format):
+        """
+        Moodle reports errors with a 200 status, in the requested format.
+        """
+        self.count('exceptions')
+        if json_format:
+            return self.json({'exception': name, 'message': message})
+        return Response(EXCEPTION_RESPONSE % (name, message),
+                        mimetype='application/xml')
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    """
+    Leaves requests out of the log, to keep load_test's output readable.
+    """
+
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+def start_server(app, host='127.0.0.1', port=0, log_requests=False):
+    """
+    Serves 'app' from a background thread, a request per thread so hanging
+    requests hold up nothing else. Port 0 picks a free port.
+
+    Returns:
+        The server, whose server_port is the port taken. Stop it with its
+        shutdown method.
+    """
+    handler = WSGIRequestHandler if log_requests else QuietRequestHandler
+    server = make_server(host, port, app, threaded=True,
+                         request_handler=handler)
+
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    return server
@@ -1,9 +1,9 @@
-import json
-import logging
+from datetime import datetime
 
-from sqlalchemy import (Boolean, Column, DateTime, Enum, Float, ForeignKey,
-                        Integer, SmallInteger, String, Text)
+from sqlalchemy import (BigInteger, Boolean, Column, DateTime, Enum, Float,
+                        ForeignKey, Integer, SmallInteger, String, Text)
 from sqlalchemy.orm import backref, relationship
+from sqlalchemy.orm.collections import attribute_mapped_collection
 from sqlalchemy.ext.declarative import declarative_base
 
 from werkzeug.security import generate_password_hash, check_password_hash
@@ -11,6 +11,23 @@ from werkzeug.security import generate_password_hash, check_password_hash
 Model = declarative_base()
 
 
+class Counter(Model):
+    """
+    A named counter that hands out blocks of increasing values.
+
+    name  : Unique name of the counter, e.g. 'course_serial'
+    value : The last value handed out by the counter
+    """
+
+    __tablename__ = 'counters'
+
+    name = Column(String(64), primary_key=True)
+    value = Column(Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return "<Counter('%s','%s')>" % (self.name, self.value)
+
+
 class SiteCourse(Model):
     """
     A representation of the connection between the courses each site has
@@ -45,6 +62,161 @@ class SiteCourse(Model):
     moodle_course_id = Column(Integer)
 
 
+class FailedInstall(Model):
+    """
+    A course that could not be installed to a site. Rows are removed again
+    once the course installs, so these are the installs left to resume.
+
+    site_id   : the site's id
+    course_id : the course's id
+    error     : What went wrong, as reported by the site or requests
+    attempts  : Number of times the install has been tried
+    failed    : Time of the latest failure
+    """
+
+    __tablename__ = 'failed_installs'
+
+    id = Column(Integer, primary_key=True)
+    site_id = Column(
+        Integer,
+        ForeignKey(
+            'sites.id',
+            use_alter=True,
+            name='fk_failed_installs_site_id'
+        ),
+        index=True
+    )
+    course_id = Column(
+        Integer,
+        ForeignKey(
+            'courses.id',
+            use_alter=True,
+            name='fk_failed_installs_course_id'
+        )
+    )
+    error = Column(Text)
+    attempts = Column(Integer, default=0)
+    failed = Column(DateTime)
+
+    def serialize(self):
+        return {'id': self.id,
+                'site_id': self.site_id,
+                'course_id': self.course_id,
+                'error': self.error,
+                'attempts': self.attempts,
+                'failed': self.failed}
+
+
+class InstallTask(Model):
+    """
+    A queued install_courses_to_site task and the rollout it belongs to.
+
+    batch   : Id shared by all the tasks queued by one rollout
+    task_id : The celery task's id
+    site_id : The site the task installs to
+    queued  : Time the task was queued
+    """
+
+    __tablename__ = 'install_tasks'
+
+    id = Column(Integer, primary_key=True)
+    batch = Column(String(36), index=True)
+    task_id = Column(String(255))
+    site_id = Column(
+        Integer,
+        ForeignKey(
+            'sites.id',
+            use_alter=True,
+            name='fk_install_tasks_site_id'
+        )
+    )
+    queued = Column(DateTime)
+
+    def serialize(self):
+        return {'id': self.id,
+                'batch': self.batch,
+                'task_id': self.task_id,
+                'site_id': self.site_id,
+                'queued': self.queued}
+
+
+class TaskLock(Model):
+    """
+    A lease keeping runs of a periodic job from overlapping. The lock is held
+    until the job's pending pieces of work are done, or until it expires,
+    whichever comes first.
+
+    name    : Unique name of the job being locked
+    holder  : Random id of the run holding the lock
+    expires : Time after which the lock is free again
+    pending : Pieces of work the holder still has running
+    """
+
+    __tablename__ = 'task_locks'
+
+    name = Column(String(64), primary_key=True)
+    holder = Column(String(36))
+    expires = Column(DateTime)
+    pending = Column(Integer, default=0)
+
+    def __repr__(self):
+        return "<TaskLock('%s','%s','%s','%s')>" % (
+            self.name, self.holder, self.expires, self.pending
+        )
+
+
+class InstallSlot(Model):
+    """
+    A lease on one of the INSTALL_MAX_PER_HOST concurrent course install
+    slots of a host. A slot is free again once released or expired, so one
+    held by a worker that died comes back on its own.
+
+    host    : Host the slot belongs to, see site_host
+    slot    : Number of the slot, below INSTALL_MAX_PER_HOST
+    holder  : Random id of the install task holding the slot
+    expires : Time after which the slot is free again
+    """
+
+    __tablename__ = 'install_slots'
+
+    host = Column(String(64), primary_key=True)
+    slot = Column(Integer, primary_key=True, autoincrement=False)
+    holder = Column(String(36))
+    expires = Column(DateTime)
+
+    def __repr__(self):
+        return "<InstallSlot('%s','%s','%s','%s')>" % (
+            self.host, self.slot, self.holder, self.expires
+        )
+
+
+class TaskSummary(Model):
+    """
+    What is kept of a celery task once its result has been compacted out of
+    celery_taskmeta.
+
+    task_id   : The celery task's id
+    status    : The task's final state, e.g. SUCCESS
+    outcome   : A short description of the result
+    date_done : Time the task finished
+    """
+
+    __tablename__ = 'task_summaries'
+
+    id = Column(Integer, primary_key=True)
+    task_id = Column(String(255), unique=True)
+    status = Column(String(50))
+    outcome = Column(String(255))
+    date_done = Column(DateTime)
+
+    def serialize(self):
+        return {'id': self.id,
+                'task_id': self.task_id,
+                'status': self.status,
+                'outcome': self.outcome,
+                'date_done': self.date_done}
+
+
 class User(Model):
     """
     A Model representation of your average User.
@@ -197,7 +369,7 @@ class Site(Model):
     basepath         : The site's path on disk - (from siteinfo)
     jenkins_cron_job : Last run of jenkins cron job, if there is one
     location         : What machine the site is on, or is it in the cloud
-    moodle_tokens    : Moodle plugins - service -> token (json)
+    tokens           : Moodle plugins - service -> SiteToken
     """
     __tablename__ = 'sites'
 
@@ -212,41 +384,33 @@ class Site(Model):
     basepath = Column(String(255))
     jenkins_cron_job = Column(DateTime)
     location = Column(String(255))
-    moodle_tokens = Column(String(2048))
 
     site_details = relationship("SiteDetail", backref=backref('sites'))
     courses = relationship("Course",
                            secondary='sites_courses',
                            backref='sites')
+    tokens = relationship("SiteToken",
+                          collection_class=attribute_mapped_collection(
+                              'service'
+                          ),
+                          cascade="all, delete-orphan")
 
     def add_token(self, service, token):
         """
-        Add token for service to moodle_tokens
+        Add token for service to the site's tokens
         """
 
-        try:
-            tokens = json.loads(self.moodle_tokens)
-        except ValueError:
-            logging.warn("%s's moodle_tokens was not JSON." % self.name)
-            tokens = {}
-
-        tokens[service] = token
-        self.moodle_tokens = json.dumps(tokens)
+        if service in self.tokens:
+            self.tokens[service].token = token
+        else:
+            self.tokens[service] = SiteToken(service=service, token=token)
 
     def remove_token(self, service):
         """
-        Remove a service/token from the site's moodle_tokens
+        Remove a service/token from the site's tokens
         """
 
-        try:
-            tokens = json.loads(self.moodle_tokens)
-        except ValueError:
-            logging.warn("%s's moodle_tokens was not JSON." % self.name)
-            return
-
-        if service in tokens.keys():
-            del tokens[service]
-            self.moodle_tokens = json.dumps(tokens)
+        self.tokens.pop(service, None)
 
     def get_token(self, service):
         """
@@ -254,23 +418,16 @@ class Site(Model):
         is found
         """
 
-        try:
-            return json.loads(self.moodle_tokens).get(service, None)
-        except ValueError:
-            logging.warn("%s's moodle_tokens was not JSON." % self.name)
+        site_token = self.tokens.get(service)
+        return site_token.token if site_token else None
 
     def get_moodle_tokens(self):
         """
-        Return a json.loads() object of moodle_tokens
+        Return a dict of service -> token for the site
         """
 
-        try:
-            tokens = json.loads(self.moodle_tokens)
-        except ValueError:
-            logging.warn("%s's moodle_tokens was not JSON." % self.name)
-            tokens = {}
-
-        return tokens
+        return dict((service, site_token.token)
+                    for service, site_token in self.tokens.iteritems())
 
     def __repr__(self):
         return "<Site('%s','%s','%s','%s','%s','%s','%s')>" % \
@@ -291,7 +448,73 @@ class Site(Model):
                 'basepath': self.basepath,
                 'jenkins_cron_job': self.jenkins_cron_job,
                 'location': self.location,
-                'moodle_tokens': self.moodle_tokens}
+                'moodle_tokens': self.get_moodle_tokens()}
+
+
+class SiteToken(Model):
+    """
+    A moodle webservice token of a site, one per service.
+
+    site_id : the site's id
+    service : Shortname of the moodle plugin's service
+    token   : Token for calling the service
+    """
+    __tablename__ = 'site_tokens'
+
+    site_id = Column(Integer, ForeignKey('sites.id',
+                                         use_alter=True,
+                                         name='fk_site_tokens_site_id'),
+                     primary_key=True)
+    service = Column(String(64), primary_key=True, index=True)
+    token = Column(String(128))
+
+    def __repr__(self):
+        return "<SiteToken('%s','%s')>" % (self.site_id, self.service)
+
+    def serialize(self):
+        return {'site_id': self.site_id,
+                'service': self.service,
+                'token': self.token}
+
+
+class SiteHealth(Model):
+    """
+    How reachable a site has been for remote calls. After enough failures in
+    a row the site's circuit opens, and it is left alone until open_until.
+
+    site_id      : the site's id
+    failures     : Number of failed calls in a row
+    last_success : Time of the last call that reached the site
+    last_failure : Time of the last call that didn't
+    last_error   : What went wrong in the last failed call
+    open_until   : Time until which calls to the site are skipped
+    """
+    __tablename__ = 'site_health'
+
+    site_id = Column(Integer, ForeignKey('sites.id',
+                                         use_alter=True,
+                                         name='fk_site_health_site_id'),
+                     primary_key=True)
+    failures = Column(Integer, default=0)
+    last_success = Column(DateTime)
+    last_failure = Column(DateTime)
+    last_error = Column(String(255))
+    open_until = Column(DateTime)
+
+    def is_open(self):
+        """
+        True while calls to the site should be skipped.
+        """
+        return bool(self.open_until and self.open_until > datetime.now())
+
+    def serialize(self):
+        return {'site_id': self.site_id,
+                'failures': self.failures,
+                'last_success': self.last_success,
+                'last_failure': self.last_failure,
+                'last_error': self.last_error,
+                'open_until': self.open_until,
+                'open': self.is_open()}
 
 
 class SiteDetail(Model):
@@ -364,6 +587,7 @@ class Course(Model):
 
     name            : The course name (a moodle setting)
     filename        : The name and extension without the full path
+    fingerprint     : sha256 of the backup file, identical archives share it
     license         : Schools with a license token matching this can
                     : install this
     moodle_course_id: Moodle course id given during the backup process
@@ -381,6 +605,7 @@ class Course(Model):
     id = Column(Integer, primary_key=True)
     name = Column(Text)
     filename = Column(Text)
+    fingerprint = Column(String(64), index=True)
     license = Column(Text)
     moodle_course_id = Column(Integer)
     moodle_version = Column(Text)
@@ -392,22 +617,24 @@ class Course(Model):
 
     def __repr__(self):
         return (
-            "<Site('%s','%s','%s','%s','%s','%s','%s','%s','%s','%s','%s')>" %
-            (self.id, self.name, self.filename, self.license,
+            "<Site('%s','%s','%s','%s','%s','%s','%s','%s','%s','%s','%s',"
+            "'%s')>" %
+            (self.id, self.name, self.filename, self.fingerprint, self.license,
              self.moodle_course_id, self.moodle_version, self.serial,
              self.shortname, self.source, self.updated, self.version)
         )
 
     def get_properties(self):
-        return ['id', 'name', 'filename', 'license', 'moodle_course_id',
-                'moodle_version', 'serial', 'shortname', 'source', 'updated',
-                'version']
+        return ['id', 'name', 'filename', 'fingerprint', 'license',
+                'moodle_course_id', 'moodle_version', 'serial', 'shortname',
+                'source', 'updated', 'version']
 
     def serialize(self):
         return {
             'id': self.id,
             'name': self.name,
             'filename': self.filename,
+            'fingerprint': self.fingerprint,
             'license': self.license,
             'moodle_course_id': self.moodle_course_id,
             'moodle_version': self.moodle_version,
@@ -417,3 +644,55 @@ class Course(Model):
             'updated': self.updated,
             'version': self.version
         }
+
+
+class CourseFile(Model):
+    """
+    The fingerprint of a course backup file as of its last scan, so later
+    scans only read the file again once it has changed.
+
+    path_hash   : sha1 of the file's path, which may be too long to index
+    path        : The file's full path
+    size        : Size of the file in bytes when it was fingerprinted
+    mtime       : Time the file was last modified when it was fingerprinted,
+                  in seconds since the epoch
+    fingerprint : sha256 of the file, see fingerprint_file
+    """
+
+    __tablename__ = 'course_files'
+
+    path_hash = Column(String(40), primary_key=True)
+    path = Column(Text)
+    size = Column(BigInteger)
+    mtime = Column(BigInteger)
+    fingerprint = Column(String(64))
+
+    def __repr__(self):
+        return "<CourseFile('%s','%s','%s','%s')>" % (
+            self.path, self.size, self.mtime, self.fingerprint
+        )
+
+
+class CourseSearchTerm(Model):
+    """
+    A searchable fragment of a course's name, shortname, source or filename.
+    Every suffix of every word is stored, so that substring searches become
+    indexed prefix searches on term.
+
+    course_id : the course's id
+    term      : a lowercased suffix of a word describing the course
+    """
+
+    __tablename__ = 'course_search_terms'
+
+    id = Column(Integer, primary_key=True)
+    course_id = Column(
+        Integer,
+        ForeignKey(
+            'courses.id',
+            use_alter=True,
+            name='fk_course_search_terms_course_id'
+        ),
+        index=True
+    )
+    term = Column(String(64), index=True)
@@ -0,0 +1,43 @@
+$(function() {
+    // Follow the rollout's progress, if one was started.
+    var table = $("#install-progress");
+    if (!table.length || !window.EventSource) {
+        return;
+    }
+
+    var source = new EventSource(table.data("events"));
+    source.addEventListener("task", function(e) {
+        $("#install-status-" + JSON.parse(e.data).site_id)
+            .text(describe_install(JSON.parse(e.data)));
+    });
+    source.addEventListener("done", function() {
+        source.close();
+    });
+    source.addEventListener("timeout", function(e) {
+        // Closed before everything finished, don't reconnect
+        source.close();
+        $.each(JSON.parse(e.data).site_ids, function(i, site_id) {
+            $("#install-status-" + site_id)
+                .append(" (no longer followed, reload to check again)");
+        });
+    });
+});
+
+function describe_install(task) {
+    /*
+    Generates a line of text describing the state of an install task.
+    */
+    if (task.status == "PROGRESS") {
+        return "Installing: " + task.done + " of " + task.total + " done";
+    } else if (task.outcome) {
+        return "Finished: " + task.outcome;
+    } else if (task.status == "SUCCESS") {
+        return "Finished: " + task.installed + " installed, " +
+               task.failed + " failed";
+    } else if (task.status == "FAILURE") {
+        return "Failed: " + task.error;
+    } else if (task.status == "MISSING") {
+        return "Unknown: the result is no longer kept";
+    }
+    return task.status;
+}
@@ -2,26 +2,47 @@
 Utility class containing useful methods not tied to specific models or views
 """
 from bs4 import BeautifulSoup as Soup
+import csv
+import hashlib
 import json
 import logging
 import os
 import re
+import uuid
 import zipfile
-from datetime import datetime
+from collections import defaultdict, deque, namedtuple
+from datetime import datetime, timedelta
 from functools import wraps
 from getpass import getpass
-
-from celery import Celery
-from flask import current_app, flash, g, redirect, render_template
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+from urlparse import urlparse
+
+from celery import Celery, chain, states
+from celery.backends.database.models import Task as TaskMeta
+from flask import (current_app, flash, g, has_app_context, redirect,
+                   render_template)
 from flask.ext.login import LoginManager, current_user
 from flask.ext.oauth import OAuth
 import requests
-from requests.exceptions import ConnectionError
+from requests.exceptions import ConnectionError, RequestException
+from sqlalchemy import and_, bindparam, func, or_, select
+from sqlalchemy.exc import IntegrityError
+
+try:
+    from os import scandir
+except ImportError:
+    # Python 2 needs the backport
+    from scandir import scandir
 
 from orvsd_central import constants
 from orvsd_central.database import create_db_session
-from orvsd_central.models import (District, School, Site, SiteDetail,
-                                  Course, User)
+from orvsd_central.models import (Counter, CourseFile, District,
+                                  FailedInstall, InstallSlot, InstallTask,
+                                  School, Site, SiteCourse, SiteDetail,
+                                  SiteHealth, SiteToken, Course,
+                                  CourseSearchTerm, TaskLock, TaskSummary,
+                                  User)
 
 # Set up a google oath object for user authentication.
 google = OAuth().remote_app(
@@ -54,8 +75,24 @@ def init_celery():
         abstract = True
 
         def __call__(self, *args, **kwargs):
+            # Run eagerly, e.g. by apply(), the task shares the caller's
+            # session
+            if has_app_context():
+                return self._call(*args, **kwargs)
+
             with current_app.app_context():
+                # g belongs to the app context, so a task needs a session of
+                # its own, removed again by shutdown_session
+                g.db_session = create_db_session()
+                return self._call(*args, **kwargs)
+
+        def _call(self, *args, **kwargs):
+            # A worker, or apply(), pushes the task's request before calling
+            # the task. TaskBase.__call__ would hide it behind an empty one,
+            # so retry() and request.retries could not see it
+            if self.request.called_directly:
                 return TaskBase.__call__(self, *args, **kwargs)
+            return self.run(*args, **kwargs)
 
     celery.Task = ContextTask
     return celery
@@ -90,7 +127,148 @@ def page_not_found(e):
     return render_template('404.html', user=current_user), 404
 
 
-def create_course_from_moodle_backup(base_path, source, file_path):
+def create_counter(name, start=0):
+    """
+    Creates the named counter with the value `start`. Another process may
+    beat us to it, in which case its row is just as good as ours.
+    """
+    g.db_session.begin_nested()
+    try:
+        g.db_session.execute(
+            Counter.__table__.insert().values(name=name, value=start)
+        )
+        g.db_session.commit()
+    except IntegrityError:
+        g.db_session.rollback()
+
+
+def allocate_counter_block(name, count=1, seed=0):
+    """
+    Reserves `count` consecutive values from the named counter.
+
+    The increment is done with a single UPDATE, which holds the counter's row
+    lock until the transaction ends, so concurrent callers always receive
+    disjoint blocks. Commit soon after allocating to release the lock.
+
+    Args:
+        name (string): Name of the counter to allocate from.
+        count (int): Number of values to reserve.
+        seed (int or callable): Value to start a missing counter at. A
+            callable is only evaluated when the counter does not exist yet.
+
+    Returns:
+        list. The reserved values in increasing order.
+    """
+    counters = Counter.__table__
+
+    updated = g.db_session.execute(
+        counters.update()
+        .where(counters.c.name == name)
+        .values(value=counters.c.value + count)
+    )
+
+    if updated.rowcount == 0:
+        # First allocation for this counter, create it.
+        create_counter(name, seed() if callable(seed) else seed)
+        return allocate_counter_block(name, count, seed)
+
+    last = g.db_session.execute(
+        select([counters.c.value]).where(counters.c.name == name)
+    ).scalar()
+
+    return range(last - count + 1, last + 1)
+
+
+def allocate_course_serials(count=1):
+    """
+    Reserves `count` new course serials.
+
+    The serial counter is seeded from the largest serial already in the
+    courses table, so existing catalogs continue where they left off.
+
+    Serials are never given back. One reserved for a backup that turns out
+    to be a new version of a known course, which shares that course's
+    serial, or that can't be read, stays unused, so the serials in the
+    catalog can have gaps.
+    """
+    def seed():
+        highest = g.db_session.query(func.max(Course.serial)).scalar()
+        return max(highest or 0, constants.COURSE_SERIAL_START - 1)
+
+    return allocate_counter_block(constants.COURSE_SERIAL_COUNTER, count, seed)
+
+
+def acquire_task_lock(name, ttl, pending=1):
+    """
+    Takes the named TaskLock if it is free.
+
+    The lock is taken with a single conditional UPDATE, so only one of
+    several processes racing for it can win.
+
+    Args:
+        name (string): Name of the job to lock.
+        ttl (int): Seconds after which the lock frees itself, in case the
+            holder never finishes.
+        pending (int): Pieces of work that have to be reported done with
+            task_lock_work_done before the lock is freed.
+
+    Returns:
+        The holder id to report work done with, or None if the lock is taken.
+    """
+    locks = TaskLock.__table__
+    now = datetime.utcnow()
+    holder = str(uuid.uuid4())
+    values = {'holder': holder,
+              'expires': now + timedelta(seconds=ttl),
+              'pending': pending}
+
+    taken = g.db_session.execute(
+        locks.update()
+        .where(and_(locks.c.name == name, locks.c.expires < now))
+        .values(**values)
+    ).rowcount == 1
+
+    if not taken and g.db_session.execute(
+        select([locks.c.name]).where(locks.c.name == name)
+    ).first() is None:
+        # Nobody has run this job yet. If another process creates the lock
+        # first, it is theirs.
+        g.db_session.begin_nested()
+        try:
+            g.db_session.execute(locks.insert().values(name=name, **values))
+            g.db_session.commit()
+            taken = True
+        except IntegrityError:
+            g.db_session.rollback()
+
+    g.db_session.commit()
+    return holder if taken else None
+
+
+def task_lock_work_done(name, holder):
+    """
+    Reports one piece of the work holding a TaskLock as done, freeing the
+    lock once nothing is pending. Does nothing if 'holder' lost the lock.
+    """
+    locks = TaskLock.__table__
+    held = and_(locks.c.name == name, locks.c.holder == holder)
+
+    g.db_session.execute(
+        locks.update().where(held).values(pending=locks.c.pending - 1)
+    )
+    pending = g.db_session.execute(
+        select([locks.c.pending]).where(held)
+    ).scalar()
+
+    if pending is not None and pending <= 0:
+        g.db_session.execute(
+            locks.update().where(held).values(expires=datetime.utcnow())
+        )
+    g.db_session.commit()
+
+
+def create_course_from_moodle_backup(base_path, source, file_path,
+                                     serial=None, fingerprint=None):
     """
     This creates a Course object from a backup xml file for FLVS/NROC courses.
 
@@ -108,13 +286,23 @@ def create_course_from_moodle_backup(base_path, source, file_path):
         file_path (string) - File path to the file we are extracting.
                     * This may have folders in the file name, for example:
                     "flvs_osl_2912/backup_algebra2.xml" is a valid file_path.
+        serial (int) - A serial reserved with allocate_course_serials. One is
+                    allocated here when not given.
+        fingerprint (string) - The file's fingerprint, if already known.
 
     Returns:
-        Nothing
+        The new Course, or None if the backup was already in the catalog.
     """
     # Needed to delete extracted xml once operation is done
     project_folder = current_app.config["PROJECT_PATH"]
 
+    # The same archive copied into another folder is not a new course, so
+    # check the fingerprint before doing any unzipping.
+    fingerprint = fingerprint or fingerprint_file(base_path + source +
+                                                  file_path)
+    if Course.query.filter_by(fingerprint=fingerprint).first():
+        return None
+
     # Unzip the file to get the manifest (All course backups are zip files)
     zip = zipfile.ZipFile(base_path + source + file_path)
     xmlfile = file(zip.extract("moodle_backup.xml"), "r")
@@ -122,38 +310,48 @@ def create_course_from_moodle_backup(base_path, source, file_path):
     info = xml.moodle_backup.information
 
     course = Course.query.filter_by(
-        name=info.original_course_fullname.string) or \
+        name=info.original_course_fullname.string).first() or \
         Course.query.filter_by(
-            name=info.original_course_shortname.string)
-
-    if not course:
-        _version_re = re.findall(r'_v(\d)_', file_path)
-
-        # Regex will only be a list if it has a value in it
-        version = _version_re[0] if list(_version_re) else None
-
-        # Create a course since one is unable to be found with that name.
-        new_course = Course(
-            name=info.original_course_fullname.string,
-            filename=file_path,
-            license=None,
-            moodle_course_id=info.original_course_id.string,
-            moodle_version=info.moodle_release.string,
-            serial=1000 + len(Course.query.all()),
-            shortname=info.original_course_shortname.string,
-            source=source.replace('/', ''),
-            updated=datetime.now(),
-            version=version
-        )
-        g.db_session.add(new_course)
+            name=info.original_course_shortname.string).first()
+
+    # A different archive of a known course is a new version of that course,
+    # which is linked to the others by sharing their serial.
+    if course:
+        serial = course.serial
+    elif serial is None:
+        serial = allocate_course_serials()[0]
+
+    _version_re = re.findall(r'_v(\d)_', file_path)
+
+    # Regex will only be a list if it has a value in it
+    version = _version_re[0] if list(_version_re) else None
+
+    new_course = Course(
+        name=info.original_course_fullname.string,
+        filename=file_path,
+        fingerprint=fingerprint,
+        license=None,
+        moodle_course_id=info.original_course_id.string,
+        moodle_version=info.moodle_release.string,
+        serial=serial,
+        shortname=info.original_course_shortname.string,
+        source=source.replace('/', ''),
+        updated=datetime.now(),
+        version=version
+    )
+    g.db_session.add(new_course)
 
-        # Until the session is committed, the new_course does not yet have
-        # an id.
-        g.db_session.commit()
+    # Until the session is flushed, the new_course does not yet have an id,
+    # which its search terms need.
+    g.db_session.flush()
+    index_courses([new_course])
+    g.db_session.commit()
 
     # Get rid of moodle_backup.xml
     os.remove(os.path.join(project_folder, "moodle_backup.xml"))
 
+    return new_course
+
 
 def district_details(schools, active):
     """
@@ -193,6 +391,124 @@ def district_details(schools, active):
             'users': user_count}
 
 
+def fingerprint_file(path, chunk_size=65536):
+    """
+    Returns the sha256 hex digest of a file's contents.
+
+    The file is read in chunks, so large course backups are never held in
+    memory all at once.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def fingerprint_files(paths):
+    """
+    Fingerprints many files with fingerprint_file, reusing the fingerprint
+    stored by an earlier scan for every file whose size and modification
+    time haven't changed since. New fingerprints are stored for the next
+    scan. The caller commits.
+
+    Returns:
+        A dict of path to fingerprint.
+    """
+    hashes = dict((hashlib.sha1(path).hexdigest(), path) for path in paths)
+    known = dict(
+        (entry.path_hash, entry) for entry in CourseFile.query.filter(
+            CourseFile.path_hash.in_(hashes.keys())
+        )
+    ) if hashes else {}
+
+    fingerprints = {}
+    for path_hash, path in hashes.iteritems():
+        stat = os.stat(path)
+        entry = known.get(path_hash)
+        if entry is None:
+            entry = CourseFile(path_hash=path_hash, path=path)
+            g.db_session.add(entry)
+
+        if entry.size != stat.st_size or entry.mtime != int(stat.st_mtime):
+            entry.size = stat.st_size
+            entry.mtime = int(stat.st_mtime)
+            entry.fingerprint = fingerprint_file(path)
+
+        fingerprints[path] = entry.fingerprint
+
+    return fingerprints
+
+
+def page_fingerprint(text):
+    """
+    Returns the sha256 hex digest of a page's text.
+    """
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def collection_timeout():
+    """
+    Returns the (connect, read) timeout for siteinfo and token requests.
+    """
+    return (current_app.config.get('COLLECTION_CONNECT_TIMEOUT', 5),
+            current_app.config.get('COLLECTION_READ_TIMEOUT', 120))
+
+
+def site_health(site):
+    """
+    Returns the SiteHealth of 'site', a fresh one if it has none yet.
+    """
+    return SiteHealth.query.get(site.id) or SiteHealth(site_id=site.id,
+                                                       failures=0)
+
+
+def site_circuit_open(site):
+    """
+    True if remote calls to 'site' are being skipped after repeated failures.
+    """
+    health = SiteHealth.query.get(site.id)
+    return bool(health and health.is_open())
+
+
+def record_site_success(site, commit=True):
+    """
+    Records that 'site' was reached, closing its circuit.
+    """
+    health = site_health(site)
+    health.failures = 0
+    health.last_success = datetime.now()
+    health.open_until = None
+    g.db_session.add(health)
+    if commit:
+        g.db_session.commit()
+
+
+def record_site_failure(site, error, commit=True):
+    """
+    Records that 'site' could not be reached.
+
+    After SITE_CIRCUIT_THRESHOLD failures in a row the circuit opens for
+    SITE_CIRCUIT_BACKOFF seconds, doubling with every further failure up to
+    SITE_CIRCUIT_MAX_BACKOFF.
+    """
+    config = current_app.config
+    health = site_health(site)
+    health.failures = (health.failures or 0) + 1
+    health.last_failure = datetime.now()
+    health.last_error = error[:255]
+
+    over = health.failures - config.get('SITE_CIRCUIT_THRESHOLD', 3)
+    if over >= 0:
+        backoff = min(config.get('SITE_CIRCUIT_BACKOFF', 3600) * 2 ** over,
+                      config.get('SITE_CIRCUIT_MAX_BACKOFF', 86400))
+        health.open_until = health.last_failure + timedelta(seconds=backoff)
+
+    g.db_session.add(health)
+    if commit:
+        g.db_session.commit()
+
+
 def gather_siteinfo(site, from_when=7):
     """
     Using the siteinfo webservice plugin for moodle, gather the siteinfo data
@@ -204,6 +520,11 @@ def gather_siteinfo(site, from_when=7):
         logging.error("Your 'site' appears to not be a site")
         return
 
+    # Sites that keep failing are left alone for a while
+    if site_circuit_open(site):
+        logging.info("%s: skipped, the site has been failing" % site.name)
+        return
+
     # If we have the siteinfo token, lets grab the data
     siteinfo_token = site.get_token('orvsd_siteinfo')
     if siteinfo_token:
@@ -211,15 +532,26 @@ def gather_siteinfo(site, from_when=7):
                     if not site.baseurl.startswith("http") else site.baseurl)
 
         # Make the request
-        req = requests.post(
-            url="%s/webservice/rest/server.php" % site_url,
-            data={
-                'wstoken': siteinfo_token,
-                'wsfunction': 'local_orvsd_siteinfo_siteinfo',
-                'moodlewsrestformat': 'json',
-                'datetime': str(from_when)
-            }
-        )
+        try:
+            req = requests.post(
+                url="%s/webservice/rest/server.php" % site_url,
+                data={
+                    'wstoken': siteinfo_token,
+                    'wsfunction': 'local_orvsd_siteinfo_siteinfo',
+                    'moodlewsrestformat': 'json',
+                    'datetime': str(from_when)
+                },
+                timeout=collection_timeout()
+            )
+        except RequestException as e:
+            logging.error("%s: Unable to connect to the site" % site.name)
+            record_site_failure(site, str(e))
+            return
+
+        if req.status_code >= 500:
+            record_site_failure(site, "HTTP %d" % req.status_code)
+        else:
+            record_site_success(site)
 
         try:
             # Add this data to the site details table
@@ -269,6 +601,7 @@ def gather_siteinfo(site, from_when=7):
 
         g.db_session.add(site_details)
         g.db_session.commit()
+        invalidate_moodle_site_index()
 
 
 def gather_tokens(site, services=[]):
@@ -276,276 +609,1446 @@ def gather_tokens(site, services=[]):
     gather_tokens will get tokens required for moodle webservices provided in
     the list of service_names list
 
-    sites: list of moodle sites to get tokens from
-    service_names: list of service names to get tokens for
+    site: moodle site to get tokens from
+    services: list of service names to get tokens for, MOODLE_SERVICES by
+              default
     """
 
     # If there are no sites listed, why is this even being called?
     if not isinstance(site, Site):
         return
 
-    # We allow for service names to be passed, though most likely only services
-    # listed in the applications config will ever be used
-    if services == []:
-        service_names = current_app.config['MOODLE_SERVICES']
+    harvest_tokens([site], services)
 
-    # If no services, nor a baseurl whys is the even being called?
-    if not services or site.baseurl in ['', None]:
-        return
 
-    # For the request, prepend the protocol if necessary
-    site_url = ("http://%s" % site.baseurl
-                if not site.baseurl.startswith("http") else site.baseurl)
+def _fetch_token(job):
+    """
+    Requests the token of one service from one site. This runs in a worker
+    thread of harvest_tokens, so it only uses what is in 'job'.
 
-    # For each service, gather a token
-    for service in service_names:
-        try:
-            # Using the siteurl and the account information stored in the
-            # config, request a token for the given service
-            resp_data = {
-                'username': current_app.config['INSTALL_COURSE_USERNAME'],
-                'password': current_app.config['INSTALL_COURSE_PASS'],
-                'service': service
-            }
-            resp = requests.post(
-                "%s/login/token.php" % site_url,
-                data=resp_data
-            )
-        except ConnectionError:
-            logging.error("%s: Unable to connect to the site" % site.name)
-            continue
+    Args:
+        job (tuple): The site id, site url, service, login data and timeout.
 
-        # Try and decode the json, if we did not receive json, we need to
-        # return the string (resp.text) back to the user as an error
-        try:
-            returned = resp.json()
-            # Check for an error log and continue
-            if 'error' in returned:
-                logging.error("%s:  %s" % (
-                    site.name,
-                    returned['error']
-                ))
-                continue
-            else:
-                current_tokens = site.get_moodle_tokens()
-                # Assign the service the retreived token
-                current_tokens[service] = returned['token']
-                # dump the json string and store it for the site
-                site.moodle_tokens = json.dumps(current_tokens)
-                # Commit the change to the database
-                g.db_session.commit()
-                logging.info(
-                    "Added '%s':'%s' to %s" %
-                    (service, returned['token'], site_url)
-                )
-        except ValueError:
-            # Unable to parse JSON, log the problem
-            logging.warning(
-                "Unable to parse JSON for %s: %s" %
-                (site_url, resp.text)
-            )
+    Returns:
+        A tuple of the site id, service, token, error and whether the site
+        was reached. Either the token or the error is None.
+    """
+    site_id, site_url, service, login, timeout = job
 
+    try:
+        resp = requests.post("%s/login/token.php" % site_url,
+                             data=dict(login, service=service),
+                             timeout=timeout)
+    except RequestException as e:
+        return site_id, service, None, str(e), False
 
-def get_course_folders(base_path):
-    """
-    Retrieves all folders in a given directory and their subdirectories.
-        * This only traverses 1 level deep.
+    if resp.status_code >= 500:
+        return site_id, service, None, "HTTP %d" % resp.status_code, False
 
-    This is meant to get a list of folders for us to look through for
-    filtering courses on the 'Course Install' page.
+    # If we did not receive json, the text is the error
+    try:
+        returned = resp.json()
+    except ValueError:
+        return (site_id, service, None,
+                "Unable to parse JSON: %s" % resp.text, True)
 
-    Args:
-        base_path (string): Path to the top level directory to look through
+    if 'token' not in returned:
+        return (site_id, service, None,
+                returned.get('error', 'No token returned'), True)
 
-    Returns:
-        All folders in a given directory and their subdirectories.
-    """
-    folders = ['None']
-    for root, sub_folders, files in os.walk(base_path):
-        for folder in sub_folders:
-            if folder not in folders:
-                folders.append(folder)
-    return folders
+    return site_id, service, returned['token'], None, True
 
 
-def get_obj_by_category(category):
+def harvest_tokens(sites, services=None):
     """
-    Maps categories to model objects.
+    Gets the tokens of every service for every site, requesting them all at
+    once with up to TOKEN_HARVEST_WORKERS requests in flight. Each site's
+    tokens and health are then stored in one commit.
+
+    Sites without a baseurl, or whose circuit is open, are skipped.
+
+    sites: list of moodle sites to get tokens from
+    services: list of service names to get tokens for, MOODLE_SERVICES by
+              default
     """
-    # Checking for case insensitive categories
-    categories = {'districts': District, 'schools': School,
-                  'sites': Site, 'courses': Course, 'users': User,
-                  'sitedetails': SiteDetail}
+    config = current_app.config
+    services = services or config['MOODLE_SERVICES']
 
-    return categories.get(category.lower())
+    # Using the account information stored in the config, request a token
+    # for each service
+    login = {'username': config['INSTALL_COURSE_USERNAME'],
+             'password': config['INSTALL_COURSE_PASS']}
+    timeout = collection_timeout()
 
+    failing = set(site_id for site_id, in g.db_session.query(
+        SiteHealth.site_id
+    ).filter(SiteHealth.open_until > datetime.now()))
 
-def get_obj_identifier(category):
-    """
-    Maps categories to their identifier.
-    An identifier is which piece of information we show to users
-    to help them identify a specific object.
-    """
-    categories = {'districts': 'name', 'schools': 'name',
-                  'sites': 'name', 'courses': 'name', 'users': 'name',
-                  'coursedetails': 'filename', 'sitedetails': 'site_id'}
+    targets = {}
+    for site in sites:
+        if site.id in failing:
+            logging.info("%s: skipped, the site has been failing" % site.name)
+        elif site.baseurl:
+            targets[site.id] = site
 
-    return categories.get(category.lower())
+    # For the request, prepend the protocol if necessary
+    jobs = [(site.id,
+             ("http://%s" % site.baseurl
+              if not site.baseurl.startswith("http") else site.baseurl),
+             service, login, timeout)
+            for site in targets.itervalues()
+            for service in services]
+    if not jobs:
+        return
 
+    pool = ThreadPool(min(config.get('TOKEN_HARVEST_WORKERS', 16), len(jobs)))
+    try:
+        results = pool.map(_fetch_token, jobs)
+    finally:
+        pool.close()
+        pool.join()
+
+    by_site = defaultdict(list)
+    for result in results:
+        by_site[result[0]].append(result[1:])
+
+    for site_id, site_results in by_site.iteritems():
+        site = targets[site_id]
+        reached = False
+        error = None
+
+        for service, token, error, site_reached in site_results:
+            reached = reached or site_reached
+            if token:
+                site.add_token(service, token)
+                logging.info("Added '%s':'%s' to %s" %
+                             (service, token, site.baseurl))
+            else:
+                logging.error("%s:  %s" % (site.name, error))
 
-# /base_path/source/path is the format of the parsed directories.
-def get_path_and_source(base_path, file_path):
-    """
-    Takes a base_path and full_file_path and returns the source and file_path.
+        if reached:
+            record_site_success(site, commit=False)
+        else:
+            record_site_failure(site, error, commit=False)
+        g.db_session.commit()
 
-    The full file path format looks something like this:
-        base_path          |   source  |          file_path
-    /data/moodle2_masters      /flvs       /flvs_osl_2012/backup_algebra2.xml
-        ^ This path can be modified in your config/default.py file ^
 
-    Args:
-        base_path (string) - The path to our FLVS/NROC folders.
-        file_path (string) - Full file path to the file we are extracting.
+def token_coverage(services=None):
+    """
+    Counts the moodle sites holding a token for each service, in one query.
+
+    services: list of service names to report on, MOODLE_SERVICES by default
 
     Returns:
-        A tuple with the source and file path (as listed above).
+        A dict of service -> {'sites': sites with a token,
+                              'missing': sites without one}
     """
-    path = file_path.replace(base_path, '').partition('/')
-    return path[0] + '/', path[2]
+    services = services or current_app.config['MOODLE_SERVICES']
 
+    total = g.db_session.query(func.count(Site.id)).filter(
+        Site.sitetype == 'moodle'
+    ).scalar()
 
-def get_active_counts():
+    counts = dict(g.db_session.query(
+        SiteToken.service, func.count(SiteToken.site_id)
+    ).join(Site, Site.id == SiteToken.site_id).filter(
+        Site.sitetype == 'moodle',
+        SiteToken.service.in_(services)
+    ).group_by(SiteToken.service).all())
+
+    return dict((service, {'sites': counts.get(service, 0),
+                           'missing': total - counts.get(service, 0)})
+                for service in services)
+
+
+def sites_missing_token(service):
     """
-    Get the active counts of all the things - schools, sites, districts, users,
-    admins, and teachers
+    Returns a query of the moodle sites without a token for 'service'.
     """
+    return Site.query.filter(
+        Site.sitetype == 'moodle',
+        ~Site.tokens.any(SiteToken.service == service)
+    ).order_by(Site.name)
 
-    # Dictionary being returned of all count data
-    active_counts = {
-        'districts': 0,
-        'schools': 0,
-        'sites': 0,
-        'courses': Course.query.count(),
-        'admins': 0,
-        'teachers': 0,
-        'totalusers': 0,
-        'activeusers': 0
-    }
 
-    # Starting from the perspective of sites
-    sites = Site.query.join(SiteDetail).distinct().all()
+def _probe_site(job):
+    """
+    Fetches the front page of one site and fingerprints it. This runs in a
+    worker thread of probe_sites, so it only uses what is in 'job'.
 
-    # When looking for districts and schools, record unique names and count
-    # those at the end
-    active_schools = set()
-    active_districts = set()
+    Returns:
+        A tuple of the url and the page's fingerprint, None if the site
+        could not be reached.
+    """
+    url, timeout = job
 
-    # For each site, check if there is a SiteDetail associated. If there is,
-    # that means the site is active and we want all the details about users.
-    for site in sites:
-        sd = SiteDetail.query.filter(
-            SiteDetail.site_id == site.id
-        ).order_by(
-            SiteDetail.timemodified.desc()
-        ).first()
+    try:
+        return url, page_fingerprint(requests.get(url, timeout=timeout).text)
+    except RequestException as e:
+        logging.warning("%s: Unable to connect to the site, %s" % (url, e))
+        return url, None
 
-        if sd:
-            # Grab all the details about the users
-            active_counts['admins'] += sd.adminusers
-            active_counts['teachers'] += sd.teachers
-            active_counts['totalusers'] += sd.totalusers
-            active_counts['activeusers'] += sd.activeusers
-            active_counts['sites'] += 1
 
-            # Add the school and district names to their respective sets for
-            # later counting
-            school = School.query.filter(School.id == site.school_id).first()
-            if school:
-                active_schools.add(school.name)
-                district = District.query.filter(
-                    District.id == school.district_id
-                ).first()
-                if district:
-                    active_districts.add(district.name)
+def probe_sites(base_urls, default_url):
+    """
+    Checks which sites are running, PROBE_WORKERS at a time. A site that
+    answers with the same page as 'default_url', a domain nginx has no site
+    for, is not running.
 
-    # Count all the unique schools and districts
-    active_counts['districts'] = len(active_districts)
-    active_counts['schools'] = len(active_schools)
+    Returns:
+        A dict of base url -> True if the site is running, False if it is
+        not, and None if it could not be reached.
+    """
+    config = current_app.config
+    timeout = (config.get('PROBE_CONNECT_TIMEOUT', 5),
+               config.get('PROBE_READ_TIMEOUT', 10))
 
-    return active_counts
+    urls = dict(("http://%s" % base_url, base_url) for base_url in base_urls)
+    jobs = [(url, timeout) for url in [default_url] + urls.keys()]
 
+    pool = ThreadPool(min(config.get('PROBE_WORKERS', 32), len(jobs)))
+    try:
+        fingerprints = dict(pool.map(_probe_site, jobs))
+    finally:
+        pool.close()
+        pool.join()
 
-def get_schools(dist_id, active):
-    """
-    Gets the active or inactive schools for a given ditrict.
+    default = fingerprints.pop(default_url)
+    if default is None:
+        raise RequestException("Unable to fetch the default page from %s" %
+                               default_url)
 
-    An active school is defined by said school not only having a site, but also
-    a SiteDetail with at least one admin, teacher, or user
+    return dict((urls[url], None if fingerprint is None
+                 else fingerprint != default)
+                for url, fingerprint in fingerprints.iteritems())
 
-    dist_id -- ID of a district to narrow the school search down with
-    active  -- Status of schools to find
+
+def _sweep_sites(name, shard_task):
     """
+    Splits the moodle sites into shards of COLLECTION_SHARD_SIZE site ids,
+    queuing 'shard_task' for each on the collection queue, unless the last
+    sweep called 'name' is still running. Sites with an open circuit are
+    left out.
 
-    # Get all schools in the district with dist_id
-    schools = School.query.filter_by(district_id=dist_id)
+    Returns:
+        The number of shards queued.
+    """
+    # Sites whose circuit is open would only be skipped by the shards
+    site_ids = [site_id for site_id, in g.db_session.query(Site.id).outerjoin(
+        SiteHealth, SiteHealth.site_id == Site.id
+    ).filter(
+        Site.sitetype == 'moodle',
+        or_(SiteHealth.open_until == None,
+            SiteHealth.open_until <= datetime.now())
+    ).order_by(Site.id)]
+
+    size = current_app.config.get('COLLECTION_SHARD_SIZE', 25)
+    shards = [site_ids[i:i + size] for i in xrange(0, len(site_ids), size)]
+    if not shards:
+        return 0
+
+    lock = 'sweep:%s' % name
+    holder = acquire_task_lock(
+        lock,
+        current_app.config.get('COLLECTION_LOCK_TIMEOUT', 21600),
+        pending=len(shards)
+    )
+    if holder is None:
+        logging.warning("Skipping %s sweep, the last one is running" % name)
+        return 0
+
+    for shard in shards:
+        shard_task.apply_async(args=(shard, (lock, holder)))
+
+    return len(shards)
+
+
+def _gather_shard(gather, site_ids, lock=None):
+    """
+    Runs 'gather' for every site in 'site_ids'. A failing site is logged and
+    skipped so it can't hold up the rest of the shard.
+    """
+    try:
+        for site in Site.query.filter(Site.id.in_(site_ids)):
+            try:
+                gather(site)
+            except Exception:
+                logging.exception("%s: collection failed" % site.name)
+                g.db_session.rollback()
+    finally:
+        if lock:
+            task_lock_work_done(*lock)
+
+
+@celery.task(name='tasks.gather_siteinfo_shard')
+def gather_siteinfo_shard(site_ids, lock=None):
+    """
+    Gathers siteinfo for a shard of sites, see sweep_siteinfo.
+    """
+    _gather_shard(gather_siteinfo, site_ids, lock)
+
+
+@celery.task(name='tasks.gather_tokens_shard')
+def gather_tokens_shard(site_ids, lock=None):
+    """
+    Gathers tokens for a shard of sites, all at once, see sweep_tokens.
+    """
+    try:
+        harvest_tokens(Site.query.filter(Site.id.in_(site_ids)).all())
+    finally:
+        if lock:
+            task_lock_work_done(*lock)
+
+
+@celery.task(name='tasks.sweep_siteinfo')
+def sweep_siteinfo():
+    """
+    Periodic task gathering siteinfo for every moodle site, spread over the
+    collection workers in shards.
+    """
+    return _sweep_sites('siteinfo', gather_siteinfo_shard)
+
+
+@celery.task(name='tasks.sweep_tokens')
+def sweep_tokens():
+    """
+    Periodic task gathering tokens for every moodle site, spread over the
+    collection workers in shards.
+    """
+    return _sweep_sites('tokens', gather_tokens_shard)
+
+
+def onboard_sites(site_ids):
+    """
+    Hands new sites to the collection workers: in shards of
+    COLLECTION_SHARD_SIZE, tokens are gathered for them and then their
+    siteinfo, which needs the tokens.
+
+    Returns:
+        The number of shards queued.
+    """
+    size = current_app.config.get('COLLECTION_SHARD_SIZE', 25)
+    shards = [site_ids[i:i + size] for i in xrange(0, len(site_ids), size)]
+
+    for shard in shards:
+        chain(gather_tokens_shard.si(shard),
+              gather_siteinfo_shard.si(shard)).apply_async()
+
+    return len(shards)
+
+
+def add_sites(rows):
+    """
+    Inserts a Site for every dict of columns in 'rows' with one statement.
+    The caller commits.
+
+    Returns:
+        The ids of the new sites.
+    """
+    if not rows:
+        return []
+
+    g.db_session.execute(Site.__table__.insert(), rows)
+    return [site_id for site_id, in g.db_session.query(Site.id).filter(
+        Site.baseurl.in_([row['baseurl'] for row in rows])
+    )]
+
+
+def remove_sites(base_urls):
+    """
+    Deletes the sites with the given base urls, along with their tokens,
+    health, course and install records, in a few set based statements.
+    Their SiteDetails are kept, without a site. The caller commits.
+
+    Returns:
+        The number of sites deleted.
+    """
+    if not base_urls:
+        return 0
+
+    site_ids = select([Site.id]).where(Site.baseurl.in_(base_urls))
+
+    for model in (SiteToken, SiteHealth, SiteCourse, FailedInstall,
+                  InstallTask):
+        g.db_session.query(model).filter(
+            model.site_id.in_(site_ids)
+        ).delete(synchronize_session=False)
+
+    g.db_session.query(SiteDetail).filter(
+        SiteDetail.site_id.in_(site_ids)
+    ).update({'site_id': None}, synchronize_session=False)
+
+    return g.db_session.query(Site).filter(
+        Site.baseurl.in_(base_urls)
+    ).delete(synchronize_session=False)
+
+
+# base_path -> (directory mtimes, folder names), see get_course_folders
+_course_folder_cache = {}
+
+
+def _scan_course_folders(base_path):
+    """
+    Walks base_path with scandir, collecting the unique folder names and the
+    mtime of every directory visited.
+    """
+    folders = ['None']
+    seen = set(folders)
+    mtimes = {base_path: os.stat(base_path).st_mtime}
+
+    pending = deque([base_path])
+    while pending:
+        for entry in scandir(pending.popleft()):
+            if not entry.is_dir():
+                continue
+
+            if entry.name not in seen:
+                seen.add(entry.name)
+                folders.append(entry.name)
+
+            # Like os.walk, list linked folders but don't descend into them
+            if not entry.is_symlink():
+                mtimes[entry.path] = entry.stat().st_mtime
+                pending.append(entry.path)
+
+    return mtimes, folders
+
+
+def _course_folders_changed(mtimes):
+    """
+    A folder being added or removed anywhere in the tree changes the mtime of
+    its parent, so stat'ing the known directories is enough to notice.
+    """
+    for path, mtime in mtimes.iteritems():
+        try:
+            if os.stat(path).st_mtime != mtime:
+                return True
+        except OSError:
+            return True
+    return False
+
+
+def invalidate_course_folders(base_path=None):
+    """
+    Drops the cached folder index for base_path, or for every path if none
+    is given, so the next get_course_folders call rescans the disk.
+    """
+    if base_path is None:
+        _course_folder_cache.clear()
+    else:
+        _course_folder_cache.pop(base_path, None)
+
+
+def get_course_folders(base_path):
+    """
+    Retrieves all folders in a given directory and their subdirectories.
+
+    This is meant to get a list of folders for us to look through for
+    filtering courses on the 'Course Install' page.
+
+    The folder index is cached per base_path and only rebuilt when a
+    directory in the tree has changed, or after invalidate_course_folders.
+
+    Args:
+        base_path (string): Path to the top level directory to look through
+
+    Returns:
+        All folders in a given directory and their subdirectories.
+    """
+    cached = _course_folder_cache.get(base_path)
+
+    if cached is None or _course_folders_changed(cached[0]):
+        try:
+            cached = _scan_course_folders(base_path)
+        except OSError:
+            logging.error("Unable to read course folders in %s" % base_path)
+            return ['None']
+        _course_folder_cache[base_path] = cached
+
+    return list(cached[1])
+
+
+# Cached result of moodle_site_index and the database state it was built for
+_moodle_site_index = {}
+
+
+def _moodle_site_index_stamp():
+    """
+    Returns a cheap summary of the sites and siteinfo tables, which changes
+    whenever new siteinfo arrives or sites are added or removed.
+    """
+    return tuple(g.db_session.query(
+        select([func.max(SiteDetail.id)]).label('max_detail_id'),
+        select([func.count(Site.id)]).label('site_count')
+    ).one())
+
+
+def invalidate_moodle_site_index():
+    """
+    Drops the cached moodle_site_index, e.g. after a site was modified.
+    """
+    _moodle_site_index.clear()
+
+
+def moodle_site_index():
+    """
+    Lists every moodle site with the release family reported by its latest
+    siteinfo, '2' for a Moodle 2.x site or None without siteinfo.
+
+    The list is built in one query and cached until new siteinfo arrives or
+    sites are added or removed, which costs one small query to check.
+
+    Returns:
+        A list of (site id, baseurl, release family) tuples.
+    """
+    stamp = _moodle_site_index_stamp()
+
+    if _moodle_site_index.get('stamp') != stamp:
+        latest = g.db_session.query(
+            SiteDetail.site_id,
+            func.max(SiteDetail.timemodified).label('timemodified')
+        ).group_by(SiteDetail.site_id).subquery()
+
+        rows = g.db_session.query(
+            Site.id, Site.baseurl, SiteDetail.siterelease
+        ).filter(
+            Site.sitetype == 'moodle'
+        ).outerjoin(
+            latest, latest.c.site_id == Site.id
+        ).outerjoin(SiteDetail, and_(
+            SiteDetail.site_id == Site.id,
+            SiteDetail.timemodified == latest.c.timemodified
+        ))
+
+        # Keyed by site id in case two siteinfos share a timemodified
+        index = dict(
+            (site_id, (site_id, baseurl,
+                       release.split('.')[0] if release else None))
+            for site_id, baseurl, release in rows
+        )
+
+        _moodle_site_index['stamp'] = stamp
+        _moodle_site_index['index'] = index.values()
+
+    return list(_moodle_site_index['index'])
+
+
+def get_obj_by_category(category):
+    """
+    Maps categories to model objects.
+    """
+    # Checking for case insensitive categories
+    categories = {'districts': District, 'schools': School,
+                  'sites': Site, 'courses': Course, 'users': User,
+                  'sitedetails': SiteDetail}
+
+    return categories.get(category.lower())
+
+
+def get_obj_identifier(category):
+    """
+    Maps categories to their identifier.
+    An identifier is which piece of information we show to users
+    to help them identify a specific object.
+    """
+    categories = {'districts': 'name', 'schools': 'name',
+                  'sites': 'name', 'courses': 'name', 'users': 'name',
+                  'coursedetails': 'filename', 'sitedetails': 'site_id'}
+
+    return categories.get(category.lower())
+
+
+# /base_path/source/path is the format of the parsed directories.
+def get_path_and_source(base_path, file_path):
+    """
+    Takes a base_path and full_file_path and returns the source and file_path.
+
+    The full file path format looks something like this:
+        base_path          |   source  |          file_path
+    /data/moodle2_masters      /flvs       /flvs_osl_2012/backup_algebra2.xml
+        ^ This path can be modified in your config/default.py file ^
+
+    Args:
+        base_path (string) - The path to our FLVS/NROC folders.
+        file_path (string) - Full file path to the file we are extracting.
+
+    Returns:
+        A tuple with the source and file path (as listed above).
+    """
+    path = file_path.replace(base_path, '').partition('/')
+    return path[0] + '/', path[2]
+
+
+def get_active_counts():
+    """
+    Get the active counts of all the things - schools, sites, districts, users,
+    admins, and teachers
+    """
+
+    # Dictionary being returned of all count data
+    active_counts = {
+        'districts': 0,
+        'schools': 0,
+        'sites': 0,
+        'courses': Course.query.count(),
+        'admins': 0,
+        'teachers': 0,
+        'totalusers': 0,
+        'activeusers': 0
+    }
+
+    # Starting from the perspective of sites
+    sites = Site.query.join(SiteDetail).distinct().all()
+
+    # When looking for districts and schools, record unique names and count
+    # those at the end
+    active_schools = set()
+    active_districts = set()
+
+    # For each site, check if there is a SiteDetail associated. If there is,
+    # that means the site is active and we want all the details about users.
+    for site in sites:
+        sd = SiteDetail.query.filter(
+            SiteDetail.site_id == site.id
+        ).order_by(
+            SiteDetail.timemodified.desc()
+        ).first()
+
+        if sd:
+            # Grab all the details about the users
+            active_counts['admins'] += sd.adminusers
+            active_counts['teachers'] += sd.teachers
+            active_counts['totalusers'] += sd.totalusers
+            active_counts['activeusers'] += sd.activeusers
+            active_counts['sites'] += 1
+
+            # Add the school and district names to their respective sets for
+            # later counting
+            school = School.query.filter(School.id == site.school_id).first()
+            if school:
+                active_schools.add(school.name)
+                district = District.query.filter(
+                    District.id == school.district_id
+                ).first()
+                if district:
+                    active_districts.add(district.name)
+
+    # Count all the unique schools and districts
+    active_counts['districts'] = len(active_districts)
+    active_counts['schools'] = len(active_schools)
+
+    return active_counts
+
+
+def get_schools(dist_id, active):
+    """
+    Gets the active or inactive schools for a given ditrict.
+
+    An active school is defined by said school not only having a site, but also
+    a SiteDetail with at least one admin, teacher, or user
+
+    dist_id -- ID of a district to narrow the school search down with
+    active  -- Status of schools to find
+    """
+
+    # Get all schools in the district with dist_id
+    schools = School.query.filter_by(district_id=dist_id)
     active_schools = schools.join(Site).join(SiteDetail).distinct()
 
-    # Dict to return for the report
-    district_info = {}
+    # Dict to return for the report
+    district_info = {}
+
+    for school in active_schools:
+        # Get the sites associated with the school
+        sites = Site.query.filter_by(school_id=school.id).distinct()
+
+        for site in sites:
+            details = SiteDetail.query.filter_by(site_id=site.id).order_by(
+                SiteDetail.timemodified.desc()
+            ).first()
+
+            district_info[str(site.id)] = {}
+            district_info[str(site.id)]['sitename'] = site.name
+            district_info[str(site.id)]['schoolname'] = school.name
+            district_info[str(site.id)]['schoolid'] = school.id
+            district_info[str(site.id)]['baseurl'] = site.baseurl
+            if details:
+                district_info[str(site.id)]['admin'] = details.adminlist
+                district_info[str(site.id)]['teachers'] = details.teachers
+                district_info[str(site.id)]['users'] = details.activeusers
+                district_info[str(site.id)]['courses'] = (
+                    len(json.loads(details.courses)) if details.courses else 0
+                )
+
+    return district_info
+
+
+def _search_words(text):
+    """
+    Splits text into the lowercased words the course search index uses.
+    Words are capped to the length of CourseSearchTerm.term.
+    """
+    return [word[:64] for word in re.findall(r'[a-z0-9]+', text.lower())]
+
+
+def course_search_terms(course):
+    """
+    Returns the set of search terms for a course: every suffix of every word
+    in its name, shortname, source and filename.
+    """
+    terms = set()
+    for field in (course.name, course.shortname, course.source,
+                  course.filename):
+        for word in _search_words(field or ''):
+            terms.update(word[i:] for i in xrange(len(word)))
+    return terms
+
+
+def index_courses(courses):
+    """
+    Replaces the search terms of the given courses, keeping the course search
+    index in sync with the catalog. Courses must have an id, so flush new
+    ones first. The caller is responsible for committing.
+    """
+    course_ids = [course.id for course in courses]
+    if not course_ids:
+        return
+
+    unindex_courses(course_ids)
+
+    rows = [{'course_id': course.id, 'term': term}
+            for course in courses
+            for term in course_search_terms(course)]
+    if rows:
+        g.db_session.execute(CourseSearchTerm.__table__.insert(), rows)
+
+
+def unindex_courses(course_ids):
+    """
+    Removes the search terms of the courses with the given ids.
+    """
+    g.db_session.execute(
+        CourseSearchTerm.__table__.delete().where(
+            CourseSearchTerm.course_id.in_(course_ids)
+        )
+    )
+
+
+def course_search_query(text):
+    """
+    Returns a query for the courses whose name, shortname, source or filename
+    contain every word of text, using the course search index. Each word may
+    match the start or the middle of a word.
+    """
+    query = Course.query
+
+    for word in _search_words(text):
+        query = query.filter(Course.id.in_(
+            select([CourseSearchTerm.course_id]).where(
+                CourseSearchTerm.term.like(word + '%')
+            )
+        ))
+
+    return query
+
+
+def search_courses(text, page=1, per_page=50):
+    """
+    Searches the catalog for courses matching text.
+
+    Args:
+        text (string): Words to look for, see course_search_query.
+        page (int): 1 based page of results to return.
+        per_page (int): Number of courses in a page.
+
+    Returns:
+        A tuple with the total number of matches and a list of the requested
+        page of courses, sorted by name.
+    """
+    query = course_search_query(text)
+
+    total = query.count()
+    courses = query.order_by(Course.name, Course.id) \
+                   .offset((page - 1) * per_page) \
+                   .limit(per_page) \
+                   .all()
+
+    return total, courses
+
+
+def course_install_data(course):
+    """
+    Returns the POST data asking the orvsd_installcourse webservice to
+    install 'course'.
+    """
+    # To get the file path we need the text input, the lowercase of
+    # source, and the filename
+    fp = os.path.join(current_app.config['INSTALL_COURSE_FILE_PATH'],
+                      course.source)
+
+    return {'filepath': fp,
+            'file': course.filename,
+            'courseid': course.id,
+            'coursename': course.name,
+            'shortname': course.shortname,
+            'category': current_app.config['INSTALL_COURSE_CATEGORY'],
+            'firstname': current_app.config['INSTALL_COURSE_FIRSTNAME'],
+            'lastname': current_app.config['INSTALL_COURSE_LASTNAME'],
+            'city': current_app.config['INSTALL_COURSE_CITY'],
+            'username': current_app.config['INSTALL_COURSE_USERNAME'],
+            'email': current_app.config['INSTALL_COURSE_EMAIL'],
+            'pass': current_app.config['INSTALL_COURSE_PASS']}
+
+
+def install_succeeded(resp):
+    """
+    Moodle reports webservice errors as an EXCEPTION document with a 200
+    status, so both need checking.
+    """
+    return resp.status_code == 200 and '<EXCEPTION' not in resp.text
+
+
+def site_host(site):
+    """
+    Returns the name of the machine serving 'site': its location when one is
+    set, otherwise the host in its baseurl.
+    """
+    if site.location:
+        return site.location
+
+    url = site.baseurl or ''
+    return urlparse(url if '://' in url else 'http://' + url).hostname or url
+
+
+def interleave_by_host(sites):
+    """
+    Orders sites so that consecutive sites are served by different hosts
+    where possible, taking one site from each host in turn. Queuing installs
+    in this order spreads them across the fleet instead of lining up every
+    site of one host at once.
+    """
+    by_host = {}
+    hosts = []
+    for site in sites:
+        host = site_host(site)
+        if host not in by_host:
+            by_host[host] = deque()
+            hosts.append(host)
+        by_host[host].append(site)
+
+    ordered = []
+    while hosts:
+        for host in list(hosts):
+            ordered.append(by_host[host].popleft())
+            if not by_host[host]:
+                hosts.remove(host)
+    return ordered
+
+
+def plan_installs(sites, courses):
+    """
+    Works out which of 'courses' still need installing to each of 'sites'.
+
+    A course is skipped for a site that already has an active SiteCourse for
+    it, or whose latest siteinfo reports a course with the same serial and
+    shortname. Both are fetched for all sites at once, so planning costs the
+    same few queries however large the rollout is.
+
+    Args:
+        sites (list): Sites to install to.
+        courses (list): Courses to install.
+
+    Returns:
+        A list of dicts, one per site in interleave_by_host order, with the
+        'site', the courses to 'install' and the courses to 'skip'.
+    """
+    site_ids = [site.id for site in sites]
+    course_ids = [course.id for course in courses]
+
+    installed = set()
+    if site_ids and course_ids:
+        installed.update(g.db_session.query(
+            SiteCourse.site_id, SiteCourse.course_id
+        ).filter(
+            SiteCourse.active == True,
+            SiteCourse.site_id.in_(site_ids),
+            SiteCourse.course_id.in_(course_ids)
+        ))
+
+        # The courses each site reported in its latest siteinfo
+        latest = g.db_session.query(
+            SiteDetail.site_id,
+            func.max(SiteDetail.timemodified).label('timemodified')
+        ).filter(
+            SiteDetail.site_id.in_(site_ids)
+        ).group_by(SiteDetail.site_id).subquery()
+
+        reported = g.db_session.query(
+            SiteDetail.site_id, SiteDetail.courses
+        ).join(latest, and_(
+            SiteDetail.site_id == latest.c.site_id,
+            SiteDetail.timemodified == latest.c.timemodified
+        ))
+
+        by_serial = defaultdict(list)
+        for course in courses:
+            by_serial[(unicode(course.serial), course.shortname)] \
+                .append(course.id)
+
+        for site_id, site_courses in reported:
+            try:
+                site_courses = json.loads(site_courses or '[]')
+            except ValueError:
+                continue
+
+            for site_course in site_courses:
+                key = (unicode(site_course.get('serial')),
+                       site_course.get('shortname'))
+                for course_id in by_serial.get(key, []):
+                    installed.add((site_id, course_id))
+
+    return [{'site': site,
+             'install': [c for c in courses
+                         if (site.id, c.id) not in installed],
+             'skip': [c for c in courses if (site.id, c.id) in installed]}
+            for site in interleave_by_host(sites)]
+
+
+def install_slot_ttl():
+    """
+    Returns the seconds an install slot is held without being renewed.
+    """
+    return current_app.config.get('INSTALL_SLOT_TTL', 3900)
+
+
+def acquire_install_slot(host):
+    """
+    Takes one of the INSTALL_MAX_PER_HOST concurrent install slots of host.
+
+    Each slot is a lease, taken with a conditional UPDATE like a TaskLock so
+    concurrent workers can never share one. It expires INSTALL_SLOT_TTL
+    seconds after it was taken or last renewed with renew_install_slot, so a
+    worker that dies mid install doesn't keep the host busy for good. Every
+    slot taken should be given back with release_install_slot.
+
+    Returns:
+        The holder id to renew and release the slot with, or None if the
+        host is busy.
+    """
+    slots = InstallSlot.__table__
+    host = host[:64]
+    limit = current_app.config.get('INSTALL_MAX_PER_HOST', 2)
+    now = datetime.utcnow()
+    holder = str(uuid.uuid4())
+    values = {'holder': holder,
+              'expires': now + timedelta(seconds=install_slot_ttl())}
+
+    held = dict(g.db_session.execute(
+        select([slots.c.slot, slots.c.expires]).where(slots.c.host == host)
+    ).fetchall())
+
+    for slot in xrange(limit):
+        if slot not in held:
+            # First time this slot is used. If another worker creates it
+            # first, it is theirs.
+            g.db_session.begin_nested()
+            try:
+                g.db_session.execute(
+                    slots.insert().values(host=host, slot=slot, **values)
+                )
+                g.db_session.commit()
+            except IntegrityError:
+                g.db_session.rollback()
+                continue
+        elif held[slot] >= now or g.db_session.execute(
+            slots.update()
+            .where(and_(slots.c.host == host,
+                        slots.c.slot == slot,
+                        slots.c.expires < now))
+            .values(**values)
+        ).rowcount != 1:
+            continue
+
+        # Commit straight away so other workers see the slot as taken
+        g.db_session.commit()
+        return holder
+
+    g.db_session.commit()
+    return None
+
+
+def renew_install_slot(host, holder):
+    """
+    Pushes back the expiry of an install slot taken with
+    acquire_install_slot, for installs that take a while.
+
+    Returns:
+        False if the slot expired and was taken by another install.
+    """
+    slots = InstallSlot.__table__
+    expires = datetime.utcnow() + timedelta(seconds=install_slot_ttl())
+
+    renewed = g.db_session.execute(
+        slots.update()
+        .where(and_(slots.c.host == host[:64], slots.c.holder == holder))
+        .values(expires=expires)
+    ).rowcount == 1
+    g.db_session.commit()
+    return renewed
+
+
+def release_install_slot(host, holder):
+    """
+    Gives back an install slot taken with acquire_install_slot. A slot that
+    already expired and went to another install is left alone.
+    """
+    slots = InstallSlot.__table__
+
+    g.db_session.execute(
+        slots.update()
+        .where(and_(slots.c.host == host[:64], slots.c.holder == holder))
+        .values(holder=None, expires=datetime.utcnow())
+    )
+    g.db_session.commit()
+
+
+def install_timeout():
+    """
+    Returns the (connect, read) timeout for course install requests.
+    """
+    return (current_app.config.get('INSTALL_CONNECT_TIMEOUT', 10),
+            current_app.config.get('INSTALL_READ_TIMEOUT', 3600))
+
 
-    for school in active_schools:
-        # Get the sites associated with the school
-        sites = Site.query.filter_by(school_id=school.id).distinct()
+def install_retry_delay(attempt):
+    """
+    Seconds to wait before retrying an install for the attempt'th time,
+    doubling INSTALL_RETRY_BACKOFF with every attempt.
+    """
+    return current_app.config.get('INSTALL_RETRY_BACKOFF', 60) * 2 ** attempt
 
-        for site in sites:
-            details = SiteDetail.query.filter_by(site_id=site.id).order_by(
-                SiteDetail.timemodified.desc()
-            ).first()
 
-            district_info[str(site.id)] = {}
-            district_info[str(site.id)]['sitename'] = site.name
-            district_info[str(site.id)]['schoolname'] = school.name
-            district_info[str(site.id)]['schoolid'] = school.id
-            district_info[str(site.id)]['baseurl'] = site.baseurl
-            if details:
-                district_info[str(site.id)]['admin'] = details.adminlist
-                district_info[str(site.id)]['teachers'] = details.teachers
-                district_info[str(site.id)]['users'] = details.activeusers
-                district_info[str(site.id)]['courses'] = (
-                    len(json.loads(details.courses)) if details.courses else 0
-                )
+def site_install_url(site):
+    """
+    Returns the url of the orvsd_installcourse webservice of 'site'.
+    """
+    install_url = ("http://%s/webservice/rest/server.php?" +
+                   "wstoken=%s&wsfunction=%s") % (
+        site.baseurl,
+        site.get_token('orvsd_installcourse'),
+        current_app.config['INSTALL_COURSE_WS_FUNCTION'])
+    return str(install_url.encode('utf-8'))
 
-    return district_info
 
+def post_course_install(http, install_url, course):
+    """
+    Asks a site to install 'course' using the requests session 'http'.
+
+    Failing to reach the site, or a 502/503 from its proxy, means the site
+    never started the restore, so those are worth retrying. Anything else,
+    including a read timeout while the site may still be restoring, is not.
+
+    Returns:
+        A tuple of whether the course was installed, the site's output or
+        the error, and whether the install may be retried.
+    """
+    try:
+        resp = http.post(install_url, data=course_install_data(course),
+                         timeout=install_timeout())
+    except ConnectionError as e:
+        return False, str(e), True
+    except RequestException as e:
+        return False, str(e), False
+
+    return (install_succeeded(resp), resp.text,
+            resp.status_code in (502, 503))
+
+
+def record_install_results(site_id, results, attempt=0):
+    """
+    Stores the outcome of installing courses to a site in one commit.
+
+    Installed courses get an active SiteCourse, reusing rows left by earlier
+    installs, and lose any FailedInstall. Courses that failed get a
+    FailedInstall, so the rollout can be resumed with just those.
+
+    Args:
+        site_id (int): The site the courses were installed to.
+        results (list): dicts with the 'course_id', whether it was
+            'installed' and the 'output', as returned by
+            install_courses_to_site.
+        attempt (int): Number of earlier tries of the failed installs.
+    """
+    course_ids = [r['course_id'] for r in results]
+    if not course_ids:
+        return
+
+    site_courses = dict(
+        (sc.course_id, sc) for sc in SiteCourse.query.filter(
+            SiteCourse.site_id == site_id,
+            SiteCourse.course_id.in_(course_ids)
+        )
+    )
+    failures = dict(
+        (f.course_id, f) for f in FailedInstall.query.filter(
+            FailedInstall.site_id == site_id,
+            FailedInstall.course_id.in_(course_ids)
+        )
+    )
+
+    for result in results:
+        course_id = result['course_id']
+        failure = failures.get(course_id)
 
-@celery.task(name='tasks.install_course')
-def install_course_to_site(course_id, install_url):
+        if result['installed']:
+            site_course = site_courses.get(course_id) or SiteCourse(
+                site_id=site_id,
+                course_id=course_id
+            )
+            site_course.active = True
+            g.db_session.add(site_course)
+            if failure:
+                g.db_session.delete(failure)
+        else:
+            if not failure:
+                failure = FailedInstall(site_id=site_id, course_id=course_id,
+                                        attempts=0)
+            # Moodle error pages can be long, the start says what happened
+            failure.error = result['output'][:4096]
+            failure.attempts += attempt + 1
+            failure.failed = datetime.now()
+            g.db_session.add(failure)
+
+    g.db_session.commit()
+
+
+@celery.task(name='tasks.install_course', bind=True)
+def install_course_to_site(self, course_id, install_url):
     """
     Installs 'course' to 'site'.
     """
-    # To get the file path we need the text input, the lowercase of
-    # source, and the filename
     course = Course.query.filter_by(id=course_id).first()
 
-    fp = os.path.join(current_app.config['INSTALL_COURSE_FILE_PATH'],
-                      course.source)
+    installed, output, retryable = post_course_install(
+        requests, install_url, course
+    )
+    if retryable:
+        raise self.retry(
+            exc=RequestException(output),
+            countdown=install_retry_delay(self.request.retries),
+            max_retries=current_app.config.get('INSTALL_MAX_RETRIES', 3)
+        )
 
-    data = {'filepath': fp,
-            'file': course.filename,
-            'courseid': course.id,
-            'coursename': course.name,
-            'shortname': course.shortname,
-            'category': current_app.config['INSTALL_COURSE_CATEGORY'],
-            'firstname': current_app.config['INSTALL_COURSE_FIRSTNAME'],
-            'lastname': current_app.config['INSTALL_COURSE_LASTNAME'],
-            'city': current_app.config['INSTALL_COURSE_CITY'],
-            'username': current_app.config['INSTALL_COURSE_USERNAME'],
-            'email': current_app.config['INSTALL_COURSE_EMAIL'],
-            'pass': current_app.config['INSTALL_COURSE_PASS']}
+    return "%s\n\n%s\n\n\n" % (course.shortname, output)
+
+
+@celery.task(name='tasks.install_courses', bind=True, max_retries=None)
+def install_courses_to_site(self, site_id, course_ids, install_url,
+                            attempt=0):
+    """
+    Installs every course in 'course_ids' to the site 'site_id'.
+
+    At most INSTALL_MAX_PER_HOST of these tasks run against the same host at
+    once. When the site's host is busy the task is retried after
+    INSTALL_HOST_RETRY_DELAY seconds, going to the back of the queue so
+    installs to other hosts get their turn. After INSTALL_MAX_HOST_RETRIES
+    tries the courses are recorded as failed installs instead.
+
+    All requests share one HTTP connection, and the task state is set to
+    PROGRESS after each course so callers can follow along. The results are
+    stored with record_install_results in a single commit at the end.
+
+    If a site can't be reached, the courses installed so far are recorded
+    and the task is retried with the remaining courses, waiting longer each
+    time, up to INSTALL_MAX_RETRIES times. Installs that still fail are left
+    as FailedInstalls for `manage.py resume_installs`.
+
+    Returns:
+        A list of dicts with the course_id, shortname, whether the course was
+        'installed' and the 'output' of the site, one per course.
+    """
+    host = site_host(Site.query.filter_by(id=site_id).first())
+    holder = acquire_install_slot(host)
+    if not holder:
+        if self.request.retries >= current_app.config.get(
+                'INSTALL_MAX_HOST_RETRIES', 120):
+            # Leave them for `manage.py resume_installs`
+            results = [{'course_id': course.id,
+                        'shortname': course.shortname,
+                        'installed': False,
+                        'output': "No install slot on %s came free" % host}
+                       for course in Course.query.filter(
+                           Course.id.in_(course_ids))]
+            record_install_results(site_id, results, attempt)
+            return results
+
+        raise self.retry(
+            countdown=current_app.config.get('INSTALL_HOST_RETRY_DELAY', 30)
+        )
+
+    try:
+        courses = Course.query.filter(Course.id.in_(course_ids)) \
+                              .order_by(Course.name).all()
+        may_retry = attempt < current_app.config.get('INSTALL_MAX_RETRIES', 3)
+
+        results = []
+        remaining = []
+        with requests.Session() as http:
+            for done, course in enumerate(courses, 1):
+                installed, output, retryable = post_course_install(
+                    http, install_url, course
+                )
+
+                if retryable and may_retry:
+                    # The site is unreachable, try this course and the rest
+                    # again later.
+                    remaining = [c.id for c in courses[done - 1:]]
+                    break
+
+                results.append({'course_id': course.id,
+                                'shortname': course.shortname,
+                                'installed': installed,
+                                'output': output})
+
+                self.update_state(state='PROGRESS', meta={
+                    'site_id': site_id,
+                    'done': done,
+                    'total': len(courses),
+                    'course_id': course.id,
+                    'installed': installed
+                })
+
+                # Keep the slot while there are more courses to go
+                renew_install_slot(host, holder)
+
+        record_install_results(site_id, results, attempt)
+    except Exception:
+        # Leave the session usable for giving back the slot
+        g.db_session.rollback()
+        raise
+    finally:
+        release_install_slot(host, holder)
+
+    # The slot is given back first, as the retry may need it
+    if remaining:
+        raise self.retry(
+            args=(site_id, remaining, install_url),
+            kwargs={'attempt': attempt + 1},
+            countdown=install_retry_delay(attempt)
+        )
+
+    return results
+
+
+def task_queue(queue):
+    """
+    Returns 'queue' if it is one of the CELERY_QUEUES, otherwise the default
+    queue, so a config from before the queues were split keeps sending tasks
+    where its workers listen.
+    """
+    config = current_app.config
+    # A dict of queue names, or a list of kombu Queues
+    queues = [getattr(q, 'name', q) for q in config.get('CELERY_QUEUES') or []]
+    if queue in queues:
+        return queue
+    return config.get('CELERY_DEFAULT_QUEUE') or 'celery'
+
+
+def queue_installs(site_courses):
+    """
+    Queues one install_courses_to_site task per site as a single rollout.
+
+    An install to a single site goes to the interactive queue, so it doesn't
+    wait behind large rollouts, which are routed by CELERY_ROUTES.
+
+    Args:
+        site_courses (list): (site, list of course ids) tuples, in the order
+            the tasks should be queued.
+
+    Returns:
+        The rollout's batch id, for following its progress.
+    """
+    batch = str(uuid.uuid4())
+    options = {}
+    if len(site_courses) == 1:
+        options['queue'] = task_queue(constants.INTERACTIVE_QUEUE)
+
+    for site, course_ids in site_courses:
+        result = install_courses_to_site.apply_async(
+            args=(site.id, course_ids, site_install_url(site)), **options
+        )
+        g.db_session.add(InstallTask(batch=batch,
+                                     task_id=result.id,
+                                     site_id=site.id,
+                                     queued=datetime.now()))
+
+    g.db_session.commit()
+    return batch
+
+
+def task_states(task_ids):
+    """
+    Looks up the celery results of many tasks in a single query.
+
+    Returns:
+        A dict of task id to celery's TaskMeta row. Tasks that have not
+        started yet have no row.
+    """
+    if not task_ids:
+        return {}
+
+    return dict(
+        (meta.task_id, meta) for meta in g.db_session.query(TaskMeta).filter(
+            TaskMeta.task_id.in_(task_ids)
+        )
+    )
+
+
+def install_task_summary(meta):
+    """
+    Summarizes the state of an install_courses_to_site task for clients,
+    leaving out the bulky output of the sites.
+
+    Args:
+        meta (TaskMeta): The task's result row, None if it has none yet.
+    """
+    if meta is None:
+        return {'status': 'PENDING'}
+
+    summary = {'status': meta.status,
+               'date_done': (meta.date_done.isoformat()
+                             if meta.date_done else None)}
+
+    if meta.status == 'PROGRESS' and isinstance(meta.result, dict):
+        summary['done'] = meta.result.get('done')
+        summary['total'] = meta.result.get('total')
+    elif meta.status == 'SUCCESS' and isinstance(meta.result, list):
+        installed = len([r for r in meta.result if r.get('installed')])
+        summary['installed'] = installed
+        summary['failed'] = len(meta.result) - installed
+    elif meta.status == 'FAILURE':
+        summary['error'] = str(meta.result)
+
+    return summary
+
+
+def install_task_summaries(queued):
+    """
+    Summarizes the install tasks of a rollout with install_task_summary,
+    looking them all up together.
+
+    A task whose result compact_task_results replaced is summarized from its
+    TaskSummary. One with neither, queued longer ago than results are kept,
+    is 'MISSING', as its result is gone for good.
+
+    Args:
+        queued (dict): The time each task id was queued, None if unknown.
+            Plain values rather than InstallTasks, so polling a rollout
+            never has to reload them.
+
+    Returns:
+        A dict of task id to summary.
+    """
+    metas = task_states(queued.keys())
+
+    unknown = [task_id for task_id in queued if task_id not in metas]
+    compacted = dict(
+        (summary.task_id, summary) for summary in TaskSummary.query.filter(
+            TaskSummary.task_id.in_(unknown)
+        )
+    ) if unknown else {}
+
+    expired = datetime.now() - timedelta(
+        days=current_app.config.get('TASK_RESULT_RETENTION_DAYS', 30)
+    )
+
+    summaries = {}
+    for task_id, queued_at in queued.iteritems():
+        meta = metas.get(task_id)
+        compact = compacted.get(task_id)
+
+        if meta is None and compact is not None:
+            summaries[task_id] = {
+                'status': compact.status,
+                'date_done': (compact.date_done.isoformat()
+                              if compact.date_done else None),
+                'outcome': compact.outcome
+            }
+        elif meta is None and queued_at and queued_at < expired:
+            summaries[task_id] = {'status': 'MISSING'}
+        else:
+            summaries[task_id] = install_task_summary(meta)
+
+    return summaries
+
+
+def task_outcome(meta):
+    """
+    Returns a short description of a finished task's result, fitting in
+    TaskSummary.outcome.
+    """
+    summary = install_task_summary(meta)
+
+    if 'installed' in summary:
+        outcome = "%d installed, %d failed" % (summary['installed'],
+                                               summary['failed'])
+    elif 'error' in summary:
+        outcome = summary['error']
+    elif meta.result is not None:
+        outcome = unicode(meta.result)
+    else:
+        outcome = ''
+
+    return outcome[:255]
+
+
+@celery.task(name='tasks.compact_task_results')
+def compact_task_results(days=None, chunk_size=500):
+    """
+    Replaces the results of tasks that finished more than 'days' days ago,
+    TASK_RESULT_RETENTION_DAYS by default, with TaskSummary rows holding
+    only their status and a short outcome.
+
+    Results are moved in chunks of 'chunk_size', each in its own commit, so
+    a large backlog never holds long locks on celery_taskmeta.
 
-    resp = requests.post(install_url, data=data, timeout=None)
+    Returns:
+        The number of task results compacted.
+    """
+    if days is None:
+        days = current_app.config.get('TASK_RESULT_RETENTION_DAYS', 30)
+    # celery records date_done in UTC
+    cutoff = datetime.utcnow() - timedelta(days=days)
+
+    compacted = 0
+    while True:
+        metas = g.db_session.query(TaskMeta).filter(
+            TaskMeta.date_done < cutoff,
+            TaskMeta.status.in_(states.READY_STATES)
+        ).order_by(TaskMeta.id).limit(chunk_size).all()
+
+        if not metas:
+            return compacted
+
+        # A task may have been summarized before, if it was ever re-run
+        task_ids = [meta.task_id for meta in metas]
+        summarized = set(task_id for task_id, in g.db_session.query(
+            TaskSummary.task_id
+        ).filter(TaskSummary.task_id.in_(task_ids)))
+
+        for meta in metas:
+            if meta.task_id not in summarized:
+                g.db_session.add(TaskSummary(task_id=meta.task_id,
+                                             status=meta.status,
+                                             outcome=task_outcome(meta),
+                                             date_done=meta.date_done))
+
+        g.db_session.query(TaskMeta).filter(
+            TaskMeta.id.in_([meta.id for meta in metas])
+        ).delete(synchronize_session=False)
+        g.db_session.commit()
 
-    return "%s\n\n%s\n\n\n" % (course.shortname, resp.text)
+        compacted += len(metas)
 
 
 @login_manager.user_loader
@@ -652,7 +2155,7 @@ def prompt_matching_passwords():
     return passwd
 
 
-def create_school_by_district_site(district, site):
+def create_school_by_district_site(district, site, commit=True):
     school = School(
         district_id=district.id,
         state_id=0,
@@ -663,5 +2166,441 @@ def create_school_by_district_site(district, site):
         county='',
     )
     g.db_session.add(school)
-    g.db_session.commit()
+    if commit:
+        g.db_session.commit()
+    else:
+        g.db_session.flush()
     return school
+
+
+def _bulk_update(model, changes):
+    """
+    Updates rows of 'model' with one executemany statement. Every dict in
+    'changes' holds the row's 'id' and the columns to set.
+    """
+    if not changes:
+        return
+
+    # The columns of the first change are set on every row
+    table = model.__table__
+    params = []
+    for change in changes:
+        change = dict(change)
+        change['_id'] = change.pop('id')
+        params.append(change)
+
+    g.db_session.execute(
+        table.update().where(table.c.id == bindparam('_id')), params
+    )
+
+
+def import_districts_schools(rows):
+    """
+    Creates or updates the districts and schools in 'rows', matching them on
+    their state ids. Existing rows are fetched in two queries, new ones are
+    inserted and changed ones updated with one statement per table. The
+    caller commits.
+
+    rows: list of (district state id, district, school state id, school,
+          county), with integer state ids
+
+    Returns:
+        A dict of counts, 'districts_created', 'districts_updated',
+        'schools_created', 'schools_updated' and 'unchanged' schools.
+    """
+    # Only words, no symbols
+    pattern = re.compile('[\W_]+')
+
+    counts = dict(districts_created=0, districts_updated=0,
+                  schools_created=0, schools_updated=0, unchanged=0)
+    if not rows:
+        return counts
+
+    district_ids = set(row[0] for row in rows)
+    districts = dict(g.db_session.query(
+        District.state_id, District
+    ).filter(District.state_id.in_(district_ids)))
+
+    # The last row of a district wins, like the last row of a school
+    district_rows = dict((row[0], {'state_id': row[0],
+                                   'name': row[1],
+                                   'shortname': pattern.sub('', row[1])})
+                         for row in rows)
+
+    new_districts = []
+    changed_districts = []
+    for state_id, values in district_rows.iteritems():
+        district = districts.get(state_id)
+        if district is None:
+            new_districts.append(values)
+        elif (district.name, district.shortname) != (values['name'],
+                                                      values['shortname']):
+            changed_districts.append(dict(values, id=district.id))
+
+    if new_districts:
+        g.db_session.execute(District.__table__.insert(), new_districts)
+    _bulk_update(District, changed_districts)
+    counts['districts_created'] = len(new_districts)
+    counts['districts_updated'] = len(changed_districts)
+
+    # District ids, including the ones just inserted
+    district_pks = dict(g.db_session.query(
+        District.state_id, District.id
+    ).filter(District.state_id.in_(district_ids)))
+
+    schools = dict(g.db_session.query(
+        School.state_id, School
+    ).filter(School.state_id.in_(set(row[2] for row in rows))))
+
+    school_rows = dict((row[2], {'district_id': district_pks[row[0]],
+                                 'state_id': row[2],
+                                 'name': row[3],
+                                 'shortname': pattern.sub('', row[3]),
+                                 'county': row[4]})
+                       for row in rows)
+
+    new_schools = []
+    changed_schools = []
+    fields = ('district_id', 'name', 'shortname', 'county')
+    for state_id, values in school_rows.iteritems():
+        school = schools.get(state_id)
+        if school is None:
+            new_schools.append(values)
+        elif any(getattr(school, field) != values[field] for field in fields):
+            changed_schools.append(dict(values, id=school.id))
+        else:
+            counts['unchanged'] += 1
+
+    if new_schools:
+        g.db_session.execute(School.__table__.insert(), new_schools)
+    _bulk_update(School, changed_schools)
+    counts['schools_created'] = len(new_schools)
+    counts['schools_updated'] = len(changed_schools)
+
+    return counts
+
+
+def parse_import_row(row):
+    """
+    Validates a row of a district and school CSV, see import_data.
+
+    Returns:
+        A tuple of district state id, district, school state id, school and
+        county, with integer state ids.
+
+    Raises:
+        ValueError if the row is malformed.
+    """
+    if len(row) < 5:
+        raise ValueError("expected 5 columns, found %d" % len(row))
+
+    district_id, district, school_id, school, county = [
+        cell.decode('utf-8').strip() for cell in row[:5]
+    ]
+
+    # Schools without a district, listed under 'z No district found', have
+    # no district state id
+    district_id = district_id or '0'
+    if not (district_id.isdigit() and school_id.isdigit()):
+        raise ValueError("state ids must be numbers")
+    if not (district and school):
+        raise ValueError("district and school names are required")
+
+    return int(district_id), district, int(school_id), school, county
+
+
+def read_import_rows(path):
+    """
+    Streams a district and school CSV one row at a time, skipping a header.
+
+    Yields:
+        Tuples of the line number, the row parsed by parse_import_row, and
+        None, or of the line number, None and why the row is invalid.
+    """
+    with open(path, 'rb') as csvfile:
+        for line, row in enumerate(csv.reader(csvfile), 1):
+            # A header has no ids, while a row may lack only its district's
+            if line == 1 and row and not any(value.strip().isdigit()
+                                             for value in row[0:3:2]):
+                continue
+
+            try:
+                yield line, parse_import_row(row), None
+            except ValueError as e:
+                yield line, None, str(e)
+
+
+def import_checkpoint(path):
+    """
+    Returns the name of the counter holding the last line of 'path' that
+    stream_import committed.
+    """
+    return 'import:%s' % hashlib.sha1(os.path.abspath(path)).hexdigest()
+
+
+def stream_import(path, chunk_size=None, resume=False):
+    """
+    Imports a district and school CSV without loading it whole: rows are
+    read and validated one at a time and upserted with
+    import_districts_schools in chunks of IMPORT_CHUNK_SIZE, each in its own
+    commit. Invalid rows are logged and skipped.
+
+    The last committed line is saved with every chunk. If the import stops
+    part way, 'resume' carries on after that line. The checkpoint is removed
+    once the whole file is imported.
+
+    Returns:
+        A dict of counts, those of import_districts_schools plus 'skipped'
+        rows and 'resumed' after line.
+    """
+    chunk_size = chunk_size or current_app.config.get('IMPORT_CHUNK_SIZE',
+                                                      500)
+    name = import_checkpoint(path)
+    checkpoint = Counter.query.get(name)
+    start = checkpoint.value if resume and checkpoint else 0
+
+    summary = defaultdict(int)
+    summary['resumed'] = start
+    chunk = []
+
+    def commit_chunk(line):
+        for key, count in import_districts_schools(chunk).iteritems():
+            summary[key] += count
+        g.db_session.merge(Counter(name=name, value=line))
+        g.db_session.commit()
+        del chunk[:]
+
+    line = start
+    for line, row, error in read_import_rows(path):
+        if line <= start:
+            continue
+
+        if error:
+            logging.warning("Line %d skipped, %s" % (line, error))
+            summary['skipped'] += 1
+            continue
+
+        chunk.append(row)
+        if len(chunk) >= chunk_size:
+            commit_chunk(line)
+
+    if chunk:
+        commit_chunk(line)
+
+    # Finished, the next import starts from the top
+    Counter.query.filter_by(name=name).delete()
+    g.db_session.commit()
+
+    return summary
+
+
+# A candidate name found by NameIndex.match, scored from 0 to 1
+NameMatch = namedtuple('NameMatch', ['id', 'name', 'score'])
+
+
+def normalize_name(name):
+    """
+    Lowercases 'name' and reduces anything but letters and digits to single
+    spaces, so 'Ashland  High-School' and 'ashland high school' compare equal.
+    """
+    return ' '.join(re.findall(r'[a-z0-9]+', (name or '').lower()))
+
+
+def bounded_levenshtein(a, b, limit):
+    """
+    Returns the levenshtein distance between 'a' and 'b', or None as soon as
+    it is known to be more than 'limit'.
+    """
+    if abs(len(a) - len(b)) > limit:
+        return None
+
+    previous = range(len(a) + 1)
+    for i, char_b in enumerate(b, 1):
+        current = [i]
+        for j, char_a in enumerate(a, 1):
+            current.append(min(previous[j] + 1,
+                               current[j - 1] + 1,
+                               previous[j - 1] + (char_a != char_b)))
+
+        # Every path to the last cell passes through this row
+        if min(current) > limit:
+            return None
+        previous = current
+
+    return previous[-1] if previous[-1] <= limit else None
+
+
+class NameIndex(object):
+    """
+    A trigram index over names, e.g. of schools or districts, for finding the
+    names a site's name contains, is contained in, or is a few edits away
+    from, without comparing it to every name.
+    """
+
+    size = 3
+
+    def __init__(self, names):
+        """
+        names: iterable of (id, name) pairs
+        """
+        # (id, name, normalized name, trigrams)
+        self.entries = []
+        # trigram -> positions in entries
+        self.postings = defaultdict(list)
+        # Names with fewer letters than a trigram, which no trigram finds
+        self.short = []
+
+        for key, name in names:
+            normalized = normalize_name(name)
+            if not normalized:
+                continue
+
+            position = len(self.entries)
+            grams = self.trigrams(normalized)
+            self.entries.append((key, name, normalized, grams))
+
+            if len(normalized) < self.size:
+                self.short.append(position)
+            for gram in grams:
+                self.postings[gram].append(position)
+
+    def trigrams(self, text):
+        return frozenset(text[i:i + self.size]
+                         for i in xrange(max(len(text) - self.size + 1, 1)))
+
+    def match(self, name, max_distance=3):
+        """
+        Finds the names that contain 'name', are contained in it or are at
+        most 'max_distance' edits from it.
+
+        Two strings within k edits of each other share all but at most
+        k * 3 of their trigrams, so only names sharing enough trigrams
+        with 'name' have their edit distance computed.
+
+        Returns:
+            A list of NameMatch, best first. Equal names score 1, others
+            the share of the longer name they have in common.
+        """
+        normalized = normalize_name(name)
+        if not normalized:
+            return []
+
+        grams = self.trigrams(normalized)
+        slack = max_distance * self.size
+
+        shared = defaultdict(int)
+        for gram in grams:
+            for position in self.postings.get(gram, ()):
+                shared[position] += 1
+
+        candidates = set(shared)
+        candidates.update(self.short)
+        if len(normalized) < self.size:
+            # Every name may contain a name this short
+            candidates = xrange(len(self.entries))
+        elif len(grams) <= slack:
+            # Short names can be a few edits apart with no trigram in common
+            candidates.update(position for position, entry
+                              in enumerate(self.entries)
+                              if len(entry[3]) <= slack)
+
+        matches = []
+        for position in candidates:
+            key, original, text, text_grams = self.entries[position]
+            longest = float(max(len(text), len(normalized)))
+
+            if text in normalized or normalized in text:
+                score = min(len(text), len(normalized)) / longest
+            elif (shared.get(position, 0) >=
+                    max(len(grams), len(text_grams)) - slack):
+                distance = bounded_levenshtein(normalized, text,
+                                               max_distance)
+                if distance is None:
+                    continue
+                score = 1 - distance / longest
+            else:
+                continue
+
+            matches.append(NameMatch(key, original, score))
+
+        matches.sort(key=lambda match: (-match.score, match.name))
+        return matches
+
+
+def best_match(matches):
+    """
+    Returns the only match in 'matches', or the best one when it is clearly
+    the name, being the only equal one. None if it is ambiguous.
+    """
+    if len(matches) == 1:
+        return matches[0]
+    if matches and matches[0].score == 1 and matches[1].score < 1:
+        return matches[0]
+    return None
+
+
+# The school and district NameIndexes of a match_orphan_sites worker
+_match_indexes = {}
+
+
+def _init_matcher(schools, districts):
+    """
+    Receives the name indexes once per match_orphan_sites worker.
+    """
+    _match_indexes['schools'] = schools
+    _match_indexes['districts'] = districts
+
+
+def _match_orphans(sites):
+    """
+    Matches (id, name) pairs of sites against the indexes given to
+    _init_matcher. A site matching exactly one school goes to it, any other
+    to its best matching district.
+
+    Returns:
+        A list of (site id, 'school' or 'district', NameMatch), leaving out
+        sites that matched neither.
+    """
+    results = []
+    for site_id, name in sites:
+        match = best_match(_match_indexes['schools'].match(name))
+        if match:
+            results.append((site_id, 'school', match))
+            continue
+
+        matches = _match_indexes['districts'].match(name)
+        if matches:
+            results.append((site_id, 'district', matches[0]))
+
+    return results
+
+
+def match_orphan_sites(sites, schools, districts, workers=1):
+    """
+    Matches sites against school and district names, see _match_orphans.
+
+    With more than one worker the sites are split across a process pool.
+    Each worker gets the read only indexes once and returns the matches for
+    its share of the sites, leaving the database to the caller.
+
+    sites: list of (id, name) pairs
+    schools, districts: NameIndex of the school and district names
+    workers: number of processes to match in
+    """
+    if workers <= 1 or len(sites) <= 1:
+        _init_matcher(schools, districts)
+        return _match_orphans(sites)
+
+    # A few chunks per worker keep them all busy to the end
+    size = max(len(sites) // (workers * 4), 1)
+    chunks = [sites[i:i + size] for i in xrange(0, len(sites), size)]
+
+    pool = Pool(workers, initializer=_init_matcher,
+                initargs=(schools, districts))
+    try:
+        results = pool.map(_match_orphans, chunks)
+    finally:
+        pool.close()
+        pool.join()
+
+    return [result for chunk in results for result in chunk]
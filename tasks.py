@@ -1,6 +1,10 @@
+import sys
+
 from celery import Celery
+from flask import g, has_app_context
 
 from orvsd_central import create_app
+from orvsd_central.database import create_db_session
 
 
 def init_celery(app):
@@ -12,8 +16,24 @@ def init_celery(app):
         abstract = True
 
         def __call__(self, *args, **kwargs):
+            # Run eagerly, e.g. by apply(), the task shares the caller's
+            # session
+            if has_app_context():
+                return self._call(*args, **kwargs)
+
             with app.app_context():
+                # g belongs to the app context, so a task needs a session of
+                # its own, removed again by shutdown_session
+                g.db_session = create_db_session()
+                return self._call(*args, **kwargs)
+
+        def _call(self, *args, **kwargs):
+            # A worker, or apply(), pushes the task's request before calling
+            # the task. TaskBase.__call__ would hide it behind an empty one,
+            # so retry() and request.retries could not see it
+            if self.request.called_directly:
                 return TaskBase.__call__(self, *args, **kwargs)
+            return self.run(*args, **kwargs)
 
     celery.Task = ContextTask
     return celery
@@ -22,4 +42,14 @@ celery_app = create_app()
 celery = init_celery(celery_app)
 
 if __name__ == "__main__":
-    celery.start()
+    argv = sys.argv
+
+    # Workers consume the configured queues unless told otherwise, e.g.
+    # `python tasks.py worker -Q interactive` for a dedicated worker.
+    queues = celery_app.config.get('CELERY_WORKER_QUEUES')
+    if 'worker' in argv and queues and not (
+            set(['-Q', '--queues']) & set(argv) or
+            any(arg.startswith('--queues=') for arg in argv)):
+        argv = argv + ['-Q', ','.join(queues)]
+
+    celery.start(argv)
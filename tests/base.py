@@ -28,6 +28,20 @@ def database_set(app):
         yield
 
 
+def attach_util(app):
+    """
+    Hooks util's login manager and database session into 'app'. util does
+    this for the app that imported it first only, which may have been
+    another test's, so tests making requests call this.
+    """
+    from orvsd_central.util import (login_manager, setup_db_session,
+                                    shutdown_session)
+    if not hasattr(app, 'login_manager'):
+        login_manager.init_app(app)
+        app.before_request(setup_db_session)
+        app.teardown_appcontext(shutdown_session)
+
+
 class TestBase(unittest.TestCase):
 
     def setUp(self, test_cfg_changes=None):
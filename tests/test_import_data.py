@@ -0,0 +1,203 @@
+"""
+Tests of the streamed district and school CSV import behind import_data
+"""
+import os
+import tempfile
+
+from flask import g
+
+from base import db_context, TestBase
+
+HEADER = 'District State ID,District,School State ID,School,County\n'
+
+ROWS = [
+    '1,Ashland SD 5,10,Ashland High School,Jackson\n',
+    '1,Ashland SD 5,11,Ashland Middle School,Jackson\n',
+    '2,Bend-La Pine SD 1,20,Bend Senior High School,Deschutes\n',
+    '2,Bend-La Pine SD 1,21,Summit High School,Deschutes\n',
+    '3,Crook County SD,30,Crook County High School,Crook\n',
+]
+
+
+class ImportTest(TestBase):
+
+    def setUp(self):
+        super(ImportTest, self).setUp()
+        self.paths = []
+
+    def tearDown(self):
+        for path in self.paths:
+            os.remove(path)
+
+    def write_csv(self, lines):
+        handle, path = tempfile.mkstemp(suffix='.csv')
+        with os.fdopen(handle, 'wb') as csvfile:
+            csvfile.write(''.join(lines))
+        self.paths.append(path)
+        return path
+
+
+class ParseImportRowTest(TestBase):
+
+    def test_valid_row(self):
+        from orvsd_central.util import parse_import_row
+
+        self.assertEqual(
+            parse_import_row(['1', ' Ashland SD 5 ', '10', 'Ashland High',
+                              'Jackson', 'extra']),
+            (1, u'Ashland SD 5', 10, u'Ashland High', u'Jackson')
+        )
+
+    def test_no_district(self):
+        from orvsd_central.util import parse_import_row
+
+        row = parse_import_row(['', 'z No district found', '10', 'Academy',
+                                'Lane'])
+        self.assertEqual(row[0], 0)
+
+    def test_invalid_rows(self):
+        from orvsd_central.util import parse_import_row
+
+        for row in (['1', 'Ashland SD 5', '10', 'Ashland High'],
+                    ['x', 'Ashland SD 5', '10', 'Ashland High', 'Jackson'],
+                    ['1', 'Ashland SD 5', '', 'Ashland High', 'Jackson'],
+                    ['1', '', '10', 'Ashland High', 'Jackson'],
+                    ['1', 'Ashland SD 5', '10', ' ', 'Jackson']):
+            self.assertRaises(ValueError, parse_import_row, row)
+
+
+class ReadImportRowsTest(ImportTest):
+
+    def test_header_skipped(self):
+        from orvsd_central.util import read_import_rows
+
+        rows = list(read_import_rows(self.write_csv([HEADER] + ROWS[:2])))
+
+        self.assertEqual([(line, error) for line, row, error in rows],
+                         [(2, None), (3, None)])
+        self.assertEqual(rows[0][1][3], u'Ashland High School')
+
+    def test_no_header(self):
+        from orvsd_central.util import read_import_rows
+
+        rows = list(read_import_rows(self.write_csv(ROWS[:2])))
+
+        self.assertEqual([line for line, row, error in rows], [1, 2])
+
+    def test_no_header_no_district(self):
+        from orvsd_central.util import read_import_rows
+
+        rows = list(read_import_rows(self.write_csv(
+            [',z No district found,1876,Academy,Lane\n', ROWS[0]]
+        )))
+
+        self.assertEqual([(line, error) for line, row, error in rows],
+                         [(1, None), (2, None)])
+        self.assertEqual(rows[0][1][0], 0)
+
+    def test_invalid_rows_numbered(self):
+        from orvsd_central.util import read_import_rows
+
+        rows = list(read_import_rows(self.write_csv(
+            [HEADER, ROWS[0], '1,Ashland SD 5\n', 'x,Ashland,10,AHS,Jackson\n']
+        )))
+
+        self.assertEqual([(line, row is None) for line, row, error in rows],
+                         [(2, False), (3, True), (4, True)])
+        self.assertEqual(rows[1][2], 'expected 5 columns, found 2')
+
+
+class StreamImportTest(ImportTest):
+
+    def schools(self):
+        from orvsd_central.models import School
+
+        return sorted(school.state_id for school in School.query.all())
+
+    def checkpoint(self, path):
+        from orvsd_central.models import Counter
+        from orvsd_central.util import import_checkpoint
+
+        counter = Counter.query.get(import_checkpoint(path))
+        return counter.value if counter else None
+
+    @db_context
+    def test_import(self):
+        from orvsd_central.models import District
+        from orvsd_central.util import stream_import
+
+        path = self.write_csv([HEADER] + ROWS[:3] + ['bad row\n'] + ROWS[3:])
+        summary = stream_import(path, chunk_size=2)
+
+        self.assertEqual(summary['districts_created'], 3)
+        self.assertEqual(summary['schools_created'], 5)
+        self.assertEqual(summary['skipped'], 1)
+        self.assertEqual(summary['resumed'], 0)
+        self.assertEqual(self.schools(), [10, 11, 20, 21, 30])
+        self.assertEqual(District.query.filter_by(state_id=2).one().name,
+                         u'Bend-La Pine SD 1')
+        # Finished, so nothing to resume from
+        self.assertEqual(self.checkpoint(path), None)
+
+    @db_context
+    def test_import_again(self):
+        from orvsd_central.util import stream_import
+
+        stream_import(self.write_csv([HEADER] + ROWS), chunk_size=2)
+        summary = stream_import(
+            self.write_csv([HEADER] + ROWS[:4] +
+                           ['3,Crook County SD,30,Crook County HS,Crook\n']),
+            chunk_size=2
+        )
+
+        self.assertEqual(summary['districts_created'], 0)
+        self.assertEqual(summary['schools_created'], 0)
+        self.assertEqual(summary['schools_updated'], 1)
+        self.assertEqual(summary['unchanged'], 4)
+
+    @db_context
+    def test_resume_after_failure(self):
+        from orvsd_central import util
+
+        path = self.write_csv([HEADER] + ROWS)
+        import_districts_schools = util.import_districts_schools
+        chunks = []
+
+        def failing_import(rows):
+            # The second chunk fails after its rows are written, before they
+            # are committed
+            counts = import_districts_schools(rows)
+            chunks.append(rows)
+            if len(chunks) == 2:
+                raise RuntimeError("connection lost")
+            return counts
+
+        util.import_districts_schools = failing_import
+        try:
+            self.assertRaises(RuntimeError, util.stream_import, path,
+                              chunk_size=2)
+        finally:
+            util.import_districts_schools = import_districts_schools
+        g.db_session.rollback()
+
+        # Only the first chunk, lines 2 and 3, was committed
+        self.assertEqual(self.schools(), [10, 11])
+        self.assertEqual(self.checkpoint(path), 3)
+
+        summary = util.stream_import(path, chunk_size=2, resume=True)
+
+        self.assertEqual(summary['resumed'], 3)
+        self.assertEqual(summary['schools_created'], 3)
+        self.assertEqual(summary.get('unchanged', 0), 0)
+        self.assertEqual(self.schools(), [10, 11, 20, 21, 30])
+        self.assertEqual(self.checkpoint(path), None)
+
+    @db_context
+    def test_resume_without_checkpoint(self):
+        from orvsd_central.util import stream_import
+
+        summary = stream_import(self.write_csv([HEADER] + ROWS[:2]),
+                                resume=True)
+
+        self.assertEqual(summary['resumed'], 0)
+        self.assertEqual(summary['schools_created'], 2)
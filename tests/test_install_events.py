@@ -0,0 +1,104 @@
+"""
+Tests of the stream of a rollout's progress at /1/installs/<batch>/events
+"""
+from datetime import datetime, timedelta
+import json
+import os
+import tempfile
+
+from flask import g
+
+from base import attach_util, db_context, TestBase
+
+
+def parse_events(data):
+    """
+    Returns the (event, data) pairs of a Server-Sent Events stream.
+    """
+    events = []
+    for block in data.split('\n\n'):
+        fields = dict(line.split(': ', 1) for line in block.split('\n')
+                      if line and not line.startswith(':'))
+        if 'event' in fields:
+            events.append((fields['event'], json.loads(fields['data'])))
+    return events
+
+
+class InstallEventsTest(TestBase):
+
+    def setUp(self):
+        # Every request opens a session of its own, so the database can't be
+        # in memory
+        handle, self.db_path = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        super(InstallEventsTest, self).setUp(test_cfg_changes={
+            'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + self.db_path,
+            'INSTALL_EVENTS_INTERVAL': 0.01,
+            'INSTALL_EVENTS_IDLE_TIMEOUT': 0.1,
+            'TASK_RESULT_RETENTION_DAYS': 30
+        })
+        attach_util(self.app)
+
+    def tearDown(self):
+        os.remove(self.db_path)
+
+    def add_tasks(self):
+        from celery.backends.database.models import Task as TaskMeta
+        from orvsd_central.models import InstallTask, TaskSummary
+
+        TaskMeta.__table__.create(g.db_session.get_bind(), checkfirst=True)
+        old = datetime.now() - timedelta(days=60)
+        g.db_session.add_all([
+            InstallTask(batch='b', task_id='compacted', site_id=1,
+                        queued=old),
+            InstallTask(batch='b', task_id='missing', site_id=2, queued=old),
+            InstallTask(batch='b', task_id='pending', site_id=3,
+                        queued=datetime.now()),
+            TaskSummary(task_id='compacted', status='SUCCESS',
+                        outcome='2 installed, 0 failed',
+                        date_done=datetime(2014, 1, 1))
+        ])
+        g.db_session.commit()
+
+    @db_context
+    def test_events(self):
+        self.add_tasks()
+
+        data = self.app.test_client().get('/1/installs/b/events').data
+        events = parse_events(data)
+
+        tasks = dict((event['task_id'], event) for kind, event in events
+                     if kind == 'task')
+        self.assertEqual(tasks['compacted']['status'], 'SUCCESS')
+        self.assertEqual(tasks['compacted']['outcome'],
+                         '2 installed, 0 failed')
+        self.assertEqual(tasks['missing']['status'], 'MISSING')
+        self.assertEqual(tasks['pending']['status'], 'PENDING')
+        # The pending task never changes, so the stream gives up on it
+        self.assertEqual(events[-1], ('timeout', {'site_ids': [3]}))
+
+    @db_context
+    def test_queries_per_poll(self):
+        from orvsd_central.benchmark import count_queries
+
+        self.add_tasks()
+
+        # The request shares the test's app context, and so its session
+        with count_queries(g.db_session.get_bind()) as queries:
+            data = self.app.test_client().get('/1/installs/b/events').data
+        polls = data.count(': waiting') + 1
+
+        # The InstallTasks once, then the results and summaries of all the
+        # tasks together each poll, however many tasks there are. Every
+        # transaction starts with a BEGIN on SQLite.
+        self.assertTrue(polls > 1)
+        self.assertTrue(queries[0] <= 2 + 3 * polls, (queries[0], polls))
+
+    @db_context
+    def test_unknown_batch(self):
+        from celery.backends.database.models import Task as TaskMeta
+
+        TaskMeta.__table__.create(g.db_session.get_bind(), checkfirst=True)
+
+        response = self.app.test_client().get('/1/installs/none/events')
+        self.assertEqual(response.status_code, 404)
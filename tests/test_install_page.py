@@ -0,0 +1,98 @@
+"""
+Tests of the course install page and the moodle site index behind it
+"""
+from datetime import datetime
+import os
+import shutil
+import tempfile
+
+from flask import g
+
+from base import attach_util, db_context, TestBase
+
+
+class MoodleSiteIndexTest(TestBase):
+
+    def setUp(self):
+        super(MoodleSiteIndexTest, self).setUp()
+        from orvsd_central.util import invalidate_moodle_site_index
+        invalidate_moodle_site_index()
+
+    @db_context
+    def test_empty(self):
+        from orvsd_central.util import moodle_site_index
+
+        self.assertEqual(moodle_site_index(), [])
+
+    @db_context
+    def test_latest_release(self):
+        from orvsd_central.models import Site, SiteDetail
+        from orvsd_central.util import moodle_site_index
+
+        moodle = Site(name='Moodle', sitetype='moodle',
+                      baseurl='moodle.example.com')
+        drupal = Site(name='Drupal', sitetype='drupal',
+                      baseurl='drupal.example.com')
+        g.db_session.add_all([moodle, drupal])
+        g.db_session.commit()
+
+        self.assertEqual(moodle_site_index(),
+                         [(moodle.id, 'moodle.example.com', None)])
+
+        # New siteinfo is seen, the latest one counts
+        g.db_session.add_all([
+            SiteDetail(site_id=moodle.id, siterelease='1.9.19',
+                       timemodified=datetime(2014, 1, 1)),
+            SiteDetail(site_id=moodle.id, siterelease='2.5.4 (Build: 1)',
+                       timemodified=datetime(2014, 2, 1))
+        ])
+        g.db_session.commit()
+
+        self.assertEqual(moodle_site_index(),
+                         [(moodle.id, 'moodle.example.com', '2')])
+
+
+class InstallPageTest(TestBase):
+
+    def setUp(self):
+        # Every request opens a session of its own, so the database can't be
+        # in memory
+        handle, self.db_path = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        self.course_path = tempfile.mkdtemp()
+        super(InstallPageTest, self).setUp(test_cfg_changes={
+            'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + self.db_path,
+            'INSTALL_COURSE_FILE_PATH': self.course_path,
+            'CSRF_ENABLED': False
+        })
+        attach_util(self.app)
+
+    def tearDown(self):
+        os.remove(self.db_path)
+        shutil.rmtree(self.course_path)
+
+    @db_context
+    def test_install_page(self):
+        from orvsd_central.constants import USER_PERMS
+        from orvsd_central.models import Site, SiteDetail, User
+        from orvsd_central.util import invalidate_moodle_site_index
+
+        user = User(name='admin', email='admin@example.com',
+                    password='hunter2', role=USER_PERMS['admin'])
+        site = Site(name='Moodle', sitetype='moodle',
+                    baseurl='moodle.example.com')
+        g.db_session.add_all([user, site])
+        g.db_session.flush()
+        g.db_session.add(SiteDetail(site_id=site.id, siterelease='2.5.4',
+                                    timemodified=datetime(2014, 2, 1)))
+        g.db_session.commit()
+        invalidate_moodle_site_index()
+
+        client = self.app.test_client()
+        with client.session_transaction() as session:
+            session['user_id'] = user.id
+
+        response = client.get('/courses/install')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('moodle.example.com', response.data)
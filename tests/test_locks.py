@@ -0,0 +1,180 @@
+"""
+Tests of the counters, task locks and install slots that keep workers apart
+"""
+from datetime import datetime, timedelta
+
+from flask import g
+
+from base import db_context, TestBase
+
+
+def expire(model, **filters):
+    """
+    Moves the expiry of the matching rows of 'model' into the past.
+    """
+    g.db_session.query(model).filter_by(**filters).update(
+        {'expires': datetime.utcnow() - timedelta(seconds=1)},
+        synchronize_session=False
+    )
+    g.db_session.commit()
+
+
+class CounterTest(TestBase):
+
+    @db_context
+    def test_blocks(self):
+        from orvsd_central.util import allocate_counter_block
+
+        self.assertEqual(allocate_counter_block('test', 3), [1, 2, 3])
+        self.assertEqual(allocate_counter_block('test', 2), [4, 5])
+        self.assertEqual(allocate_counter_block('other'), [1])
+
+    @db_context
+    def test_seed(self):
+        from orvsd_central.util import allocate_counter_block
+
+        seeds = []
+
+        def seed():
+            seeds.append(1)
+            return 41
+
+        self.assertEqual(allocate_counter_block('test', 1, seed), [42])
+        self.assertEqual(allocate_counter_block('test', 1, seed), [43])
+        # Only needed to create the counter
+        self.assertEqual(len(seeds), 1)
+
+    @db_context
+    def test_create_existing(self):
+        from orvsd_central.models import Counter
+        from orvsd_central.util import create_counter
+
+        create_counter('test', 5)
+        g.db_session.add(Counter(name='pending', value=1))
+        g.db_session.flush()
+
+        # Losing the race leaves the counter, and the caller's transaction
+        create_counter('test', 10)
+
+        self.assertEqual(Counter.query.get('test').value, 5)
+        self.assertEqual(Counter.query.get('pending').value, 1)
+
+    @db_context
+    def test_course_serials(self):
+        from orvsd_central.constants import COURSE_SERIAL_START
+        from orvsd_central.util import allocate_course_serials
+
+        self.assertEqual(allocate_course_serials(2),
+                         [COURSE_SERIAL_START, COURSE_SERIAL_START + 1])
+
+    @db_context
+    def test_course_serials_after_catalog(self):
+        from orvsd_central.models import Course
+        from orvsd_central.util import allocate_course_serials
+
+        g.db_session.add(Course(name='Algebra', serial=5000))
+        g.db_session.commit()
+
+        self.assertEqual(allocate_course_serials(), [5001])
+
+
+class TaskLockTest(TestBase):
+
+    @db_context
+    def test_taken_once(self):
+        from orvsd_central.util import acquire_task_lock
+
+        holder = acquire_task_lock('sweep', 60)
+
+        self.assertTrue(holder)
+        self.assertEqual(acquire_task_lock('sweep', 60), None)
+        self.assertTrue(acquire_task_lock('other', 60))
+
+    @db_context
+    def test_expired(self):
+        from orvsd_central.models import TaskLock
+        from orvsd_central.util import acquire_task_lock
+
+        holder = acquire_task_lock('sweep', 60)
+        expire(TaskLock, name='sweep')
+
+        taken = acquire_task_lock('sweep', 60)
+        self.assertTrue(taken)
+        self.assertNotEqual(taken, holder)
+
+    @db_context
+    def test_work_done(self):
+        from orvsd_central.util import acquire_task_lock, task_lock_work_done
+
+        holder = acquire_task_lock('sweep', 60, pending=2)
+
+        task_lock_work_done('sweep', holder)
+        self.assertEqual(acquire_task_lock('sweep', 60), None)
+
+        task_lock_work_done('sweep', holder)
+        self.assertTrue(acquire_task_lock('sweep', 60))
+
+    @db_context
+    def test_work_done_by_lost_holder(self):
+        from orvsd_central.models import TaskLock
+        from orvsd_central.util import acquire_task_lock, task_lock_work_done
+
+        holder = acquire_task_lock('sweep', 60)
+        expire(TaskLock, name='sweep')
+        acquire_task_lock('sweep', 60)
+
+        task_lock_work_done('sweep', holder)
+        self.assertEqual(acquire_task_lock('sweep', 60), None)
+
+
+class InstallSlotTest(TestBase):
+
+    def setUp(self):
+        super(InstallSlotTest, self).setUp(test_cfg_changes={
+            'INSTALL_MAX_PER_HOST': 2
+        })
+
+    @db_context
+    def test_limit(self):
+        from orvsd_central.util import acquire_install_slot
+
+        first = acquire_install_slot('host')
+        second = acquire_install_slot('host')
+
+        self.assertTrue(first and second)
+        self.assertNotEqual(first, second)
+        self.assertEqual(acquire_install_slot('host'), None)
+        # Every host has slots of its own
+        self.assertTrue(acquire_install_slot('other'))
+
+    @db_context
+    def test_release(self):
+        from orvsd_central.util import (acquire_install_slot,
+                                        release_install_slot)
+
+        first = acquire_install_slot('host')
+        acquire_install_slot('host')
+        release_install_slot('host', first)
+
+        self.assertTrue(acquire_install_slot('host'))
+        self.assertEqual(acquire_install_slot('host'), None)
+
+    @db_context
+    def test_expired(self):
+        from orvsd_central.models import InstallSlot
+        from orvsd_central.util import (acquire_install_slot,
+                                        release_install_slot,
+                                        renew_install_slot)
+
+        stale = acquire_install_slot('host')
+        acquire_install_slot('host')
+        expire(InstallSlot, host='host', holder=stale)
+
+        taken = acquire_install_slot('host')
+        self.assertTrue(taken)
+
+        # The worker that lost the slot can't renew or give it back
+        self.assertFalse(renew_install_slot('host', stale))
+        release_install_slot('host', stale)
+        self.assertEqual(acquire_install_slot('host'), None)
+        self.assertTrue(renew_install_slot('host', taken))
@@ -0,0 +1,167 @@
+"""
+Tests of the fuzzy name matching behind assoc_sites_districts
+"""
+import os
+import random
+import tempfile
+
+from flask import g
+
+from base import db_context, TestBase
+
+
+def levenshtein(a, b):
+    """
+    Unbounded levenshtein distance, to check bounded_levenshtein against.
+    """
+    previous = range(len(b) + 1)
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(previous[j] + 1,
+                               current[j - 1] + 1,
+                               previous[j - 1] + (char_a != char_b)))
+        previous = current
+    return previous[-1]
+
+
+class BoundedLevenshteinTest(TestBase):
+
+    def test_matches_unbounded_distance(self):
+        from orvsd_central.util import bounded_levenshtein
+
+        rand = random.Random(1)
+
+        def word():
+            return ''.join(rand.choice('ab c')
+                           for _ in xrange(rand.randint(0, 8)))
+
+        for _ in xrange(500):
+            a, b = word(), word()
+            distance = levenshtein(a, b)
+            for limit in xrange(5):
+                expected = distance if distance <= limit else None
+                self.assertEqual(bounded_levenshtein(a, b, limit), expected,
+                                 (a, b, limit))
+
+    def test_known_distances(self):
+        from orvsd_central.util import bounded_levenshtein
+
+        self.assertEqual(bounded_levenshtein('kitten', 'sitting', 3), 3)
+        self.assertEqual(bounded_levenshtein('kitten', 'sitting', 2), None)
+        self.assertEqual(bounded_levenshtein('', 'abc', 3), 3)
+        self.assertEqual(bounded_levenshtein('same', 'same', 0), 0)
+
+
+class NameIndexTest(TestBase):
+
+    def test_normalized_names_are_equal(self):
+        from orvsd_central.util import NameIndex
+
+        index = NameIndex([(1, 'Ashland  High-School')])
+        matches = index.match('ashland high school')
+
+        self.assertEqual([(m.id, m.score) for m in matches], [(1, 1)])
+
+    def test_ranks_best_first(self):
+        from orvsd_central.util import NameIndex
+
+        index = NameIndex([(1, 'Ashland High'),
+                           (2, 'Ashland High School'),
+                           (3, 'Ashland Middle School'),
+                           (4, 'Crater Lake School')])
+        matches = index.match('Ashland High School')
+
+        # Equal first, then contained, the unrelated names not at all
+        self.assertEqual([m.id for m in matches], [2, 1])
+        self.assertEqual(matches[0].score, 1)
+        self.assertAlmostEqual(matches[1].score, 12 / 19.0)
+
+    def test_max_distance(self):
+        from orvsd_central.util import NameIndex
+
+        index = NameIndex([(1, 'Crater Lake')])
+
+        # Three substitutions are close enough, four are not
+        matches = index.match('Crxter Lxkx')
+        self.assertEqual([m.id for m in matches], [1])
+        self.assertAlmostEqual(matches[0].score, 1 - 3 / 11.0)
+        self.assertEqual(index.match('Crxtxr Lxkx'), [])
+        self.assertEqual([m.id for m in
+                          index.match('Crxtxr Lxkx', max_distance=4)], [1])
+
+    def test_short_names(self):
+        from orvsd_central.util import NameIndex
+
+        index = NameIndex([(1, 'OR'), (2, 'Bend')])
+
+        # Found without a trigram in common
+        self.assertEqual([m.id for m in index.match('Or')], [1])
+        matches = index.match('Bond')
+        self.assertEqual(matches[0].id, 2)
+        self.assertAlmostEqual(matches[0].score, 0.75)
+
+
+class BestMatchTest(TestBase):
+
+    def test_best_match(self):
+        from orvsd_central.util import NameMatch, best_match
+
+        only = NameMatch(1, 'Only', 0.5)
+        equal = NameMatch(2, 'Equal', 1)
+        close = NameMatch(3, 'Close', 0.9)
+
+        self.assertEqual(best_match([]), None)
+        self.assertEqual(best_match([only]), only)
+        self.assertEqual(best_match([equal, close]), equal)
+        # Two equal names, or none, are ambiguous
+        self.assertEqual(best_match([equal, equal._replace(id=4)]), None)
+        self.assertEqual(best_match([close, only]), None)
+
+
+class AssocSitesDistrictsTest(TestBase):
+
+    def setUp(self):
+        # The command opens a session of its own, so the database can't be
+        # in memory
+        handle, self.db_path = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        super(AssocSitesDistrictsTest, self).setUp(test_cfg_changes={
+            'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + self.db_path
+        })
+
+    def tearDown(self):
+        os.remove(self.db_path)
+
+    @db_context
+    def test_districts_of_unmatched_sites(self):
+        from manage import assoc_sites_districts
+        from orvsd_central.models import District, School, Site
+
+        ashland = District(state_id=1, name='Ashland', shortname='Ashland')
+        lincoln = District(state_id=2, name='Lincoln', shortname='Lincoln')
+        g.db_session.add_all([ashland, lincoln])
+        g.db_session.flush()
+        g.db_session.add_all([
+            School(district_id=ashland.id, state_id=10,
+                   name='Ashland High School'),
+            School(district_id=lincoln.id, state_id=20, name='Lincoln High'),
+            School(district_id=lincoln.id, state_id=21, name='Lincoln Hills')
+        ])
+        g.db_session.add_all([
+            Site(name='Ashland High School', baseurl='ahs.example.com'),
+            # Close to both Lincoln schools, so matched by its district
+            Site(name='Lincoln Hi', baseurl='lhi.example.com')
+        ])
+        g.db_session.commit()
+
+        assoc_sites_districts(1)
+
+        schools = dict((site.name, School.query.get(site.school_id))
+                       for site in Site.query.all())
+        self.assertEqual(schools['Ashland High School'].name,
+                         'Ashland High School')
+        # Its own district, not the first one close to the last school
+        # compared
+        self.assertEqual(schools['Lincoln Hi'].district.name, 'Lincoln')
+        self.assertEqual(schools['Lincoln Hi'].name, 'Lincoln School')